@@ -1,16 +1,25 @@
 import argparse
+import asyncio
+import hashlib
 import os
-import requests
 import shlex
 import sys
+import time
+
+import httpx
+import websockets
+
 from crypto import ecdh
-from crypto.ecc import scalar_mult
-from src.settings import ADDRESS, MITM_PROXY
-from utils import report_success, encrypt_note, decrypt_note
+from src.settings import ADDRESS, CLI_CONCURRENCY, CLI_STATE_DIR, MAX_BATCH_SIZE, MAX_NOTE_TOKENS, MAX_NOTES_PAGE_SIZE
+from src.settings import NOTE_CHUNK_SIZE
+from client import Client, HandshakeFailed
+from utils import (report_success, encrypt_note, decrypt_note, encrypt_file, decrypt_to_file, derive_search_key,
+                   load_state, save_state, search_tokens)
 
 
 users = {}
 current_username = None
+client = None
 
 
 class User:
@@ -18,121 +27,320 @@ class User:
         # Alice generates her own keypair.
         self.private_key, self.public_key = ecdh.make_keypair()
         self.shared_secret = None
+        # Monotonic time at which the client repeats the handshake.
+        self.key_expires = 0
         self.jwt = jwt
         self.notes = {}
+        # Change cursor of the last sync, kept with the notes between sessions.
+        self.since = 0
+        # (since, ETag) of the last sync request, answered with 304 while nothing changes.
+        self.etag = None
         self.username = username
+        self.state_key = None
+        self.search_key = None
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.jwt}'}
+
+    def state_path(self):
+        server = hashlib.sha256(ADDRESS.encode()).hexdigest()[:16]
+        return os.path.join(CLI_STATE_DIR, f'{self.username}-{server}.state')
+
+    def load(self, password):
+        """Opens the notes saved by the last session with a key derived from the login password."""
+        self.state_key = hashlib.sha256(f'{self.username}:{password}'.encode()).digest()
+        self.search_key = derive_search_key(self.username, password)
+        state = load_state(self.state_path(), self.state_key)
+        if state is not None:
+            self.notes, self.since = state['notes'], state['since']
+
+    def save(self):
+        if self.state_key is not None:
+            save_state(self.state_path(), self.state_key, {'notes': self.notes, 'since': self.since})
 
+    def tokens(self, content):
+        tokens = search_tokens(self.search_key, content)
+        # Notes with more distinct words than the server indexes are left unsearchable.
+        return tokens if len(tokens) <= MAX_NOTE_TOKENS else None
 
-def register(args):
-    response = requests.post(ADDRESS + 'auth/register',
-                             json={
-                                 'email': args.username + '@example.com',
-                                 'password': args.password
-                             },
-                             proxies=MITM_PROXY)
 
-    report_success(response, 201)
+async def register(args):
+    response = await client.post('auth/register',
+                                 json={
+                                     'email': args.username + '@example.com',
+                                     'password': args.password
+                                 })
 
+    return report_success(response, 201)
 
-def login(args):
+
+async def login(args):
     global current_username
-    response = requests.post(ADDRESS + 'auth/jwt/login',
-                             data={
-                                 'username': args.username + '@example.com',
-                                 'password': args.password
-                             },
-                             proxies=MITM_PROXY)
+    response = await client.post('auth/jwt/login',
+                                 data={
+                                     'username': args.username + '@example.com',
+                                     'password': args.password
+                                 })
+    if not report_success(response):
+        return False
 
     users[args.username] = User(args.username, response.json()['access_token'])
+    users[args.username].load(args.password)
 
     current_username = args.username
-    report_success(response)
-    handshake()
+    return await handshake()
+
+
+async def handshake(args=None):
+    ok = await client.handshake(users[current_username])
+    print('Successful' if ok else 'Failed')
+    return ok
 
 
-def handshake(args=None):
+async def get_notes(args=None):
     user = users[current_username]
-    response = requests.get(ADDRESS + 'get_public_key',
-                            json={'public_key': str(user.public_key)},
-                            headers={'Authorization': f'Bearer {user.jwt}'},
-                            proxies=MITM_PROXY)
-    if report_success(response):
-        user.shared_secret = scalar_mult(user.private_key, eval(response.json()['public_key']))
+    notes = dict(user.notes)
+    since = user.since
+    while True:
+        headers = {}
+        if user.etag is not None and user.etag[0] == since:
+            headers['If-None-Match'] = user.etag[1]
+        response = await client.request(user, 'GET', 'get_notes',
+                                        params={'limit': MAX_NOTES_PAGE_SIZE, 'since': since},
+                                        headers=headers)
+        if response.status_code == 304:
+            break
+        if 'ETag' in response.headers:
+            user.etag = (since, response.headers['ETag'])
+        body = response.json()
+        if response.status_code != 200 or not isinstance(body['message'], list):
+            report_success(response)
+            return False
+        apply_changes(user, notes, body['message'])
+        since = body['since']
+        if body['next_cursor'] is None:
+            break
+    store_sync(user, notes, since)
+    print('Successful')
+    print('Available notes:', ', '.join(user.notes))
+    return True
+
+
+def apply_changes(user, notes, changes):
+    """Applies a page of an incremental sync to notes."""
+    for note in changes:
+        name, content = decrypt_note(user.shared_secret[0], note['name'], note['message'])
+        if note['deleted']:
+            notes.pop(name, None)
+        else:
+            notes[name] = content
 
 
-def check_response(response, func, args, expected_code=200):
-    if response.status_code == expected_code and response.json()['message'] is not None and 'handshake required' in \
-            response.json()['message']:
-        handshake()
-        func(args)
+def store_sync(user, notes, since):
+    """Keeps the result of a sync, returning whether anything changed."""
+    if (notes, since) == (user.notes, user.since):
+        return False
+    user.notes, user.since = notes, since
+    user.save()
+    return True
 
 
-def get_notes(args=None):
-    user = users[current_username]
-    response = requests.get(ADDRESS + 'get_notes',
-                            headers={'Authorization': f'Bearer {user.jwt}'},
-                            proxies=MITM_PROXY)
-    check_response(response, get_notes, args)
-    if report_success(response):
-        for note in response.json()['message']:
-            name, content = decrypt_note(user.shared_secret[0], note['name'], note['message'])
-            user.notes[name] = content
+async def sync_channel(user, channel):
+    notes = dict(user.notes)
+    since = user.since
+    while True:
+        reply = await channel.request('get', since=since, limit=MAX_NOTES_PAGE_SIZE)
+        if reply['message'] == 'handshake required' and await channel.handshake(user):
+            continue
+        if not isinstance(reply['message'], list):
+            print(reply['message'])
+            return False
+        apply_changes(user, notes, reply['message'])
+        since = reply['since']
+        if reply['next_cursor'] is None:
+            break
+    if store_sync(user, notes, since):
         print('Available notes:', ', '.join(user.notes))
+    return True
 
 
-def create(args):
+async def watch(args):
+    """Keeps the notes in sync over a WebSocket channel, fetching changes as soon as the server announces them."""
+    user = users[current_username]
+    deadline = None if args.seconds is None else time.monotonic() + args.seconds
+    async with client.channel(user) as channel:
+        if not await channel.handshake(user):
+            print('Failed')
+            return False
+        while True:
+            channel.changed.clear()
+            if not await sync_channel(user, channel):
+                return False
+            try:
+                await asyncio.wait_for(channel.changed.wait(),
+                                       None if deadline is None else max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                return True
+
+
+async def upload(args, method):
+    """Streams a file as the content of a note; the server stores it in chunks."""
+    user = users[current_username]
+    response = await client.request(user, method, 'notes/content',
+                                    encode=lambda secret: {
+                                        'params': {'name': encrypt_note(secret, args.note_name)[0]},
+                                        'content': encrypt_file(secret, args.file, NOTE_CHUNK_SIZE)
+                                    })
+    if report_success(response) and isinstance(response.json()['message'], dict):
+        # Streamed notes are not kept in memory; use save to download them.
+        user.notes[args.note_name] = None
+        user.save()
+        return True
+    print(response.json()['message'])
+    return False
+
+
+async def save(args):
     user = users[current_username]
-    name, content = encrypt_note(user.shared_secret[0], args.note_name, args.content)
-
-    response = requests.post(ADDRESS + 'create_note',
-                             headers={'Authorization': f'Bearer {user.jwt}'},
-                             json={
-                                 'name': name,
-                                 'message': content
-                             },
-                             proxies=MITM_PROXY)
-    check_response(response, create, args)
+    response = await client.request(user, 'GET', 'notes/content', stream=True,
+                                    encode=lambda secret: {'params': {'name': encrypt_note(secret, args.note_name)[0]}})
+    try:
+        if response.headers.get('Content-Type') != 'application/octet-stream':
+            report_success(response)
+            print(response.json()['message'])
+            return False
+        await decrypt_to_file(user.shared_secret[0], response.aiter_bytes(NOTE_CHUNK_SIZE), args.path)
+    except ValueError:
+        print('ECDH error')
+        return False
+    finally:
+        await response.aclose()
+    print('Successful')
+    return True
+
+
+async def put_note(user, path, name, content):
+    """Creates or edits one note and returns whether the server accepted it."""
+    response = await client.request(user, 'POST', path,
+                                    encode=lambda secret: {'json': dict(
+                                        zip(('name', 'message'), encrypt_note(secret, name, content)),
+                                        tokens=user.tokens(content)
+                                    )})
+    if not report_success(response):
+        return False
+    note = response.json()['message']
+    if not isinstance(note, dict):
+        print(note)
+        return False
+    name, content = decrypt_note(user.shared_secret[0], note['name'], note['message'])
+    user.notes[name] = content
+    user.save()
+    return True
+
+
+async def create(args):
+    if args.file is not None:
+        return await upload(args, 'POST')
+    return await put_note(users[current_username], 'create_note', args.note_name, args.content)
+
+
+async def edit(args):
+    if args.file is not None:
+        return await upload(args, 'PUT')
+    return await put_note(users[current_username], 'edit_note', args.note_name, args.content)
+
+
+async def delete_note(user, name):
+    response = await client.request(user, 'DELETE', 'delete_note',
+                                    encode=lambda secret: {'json': {'name': encrypt_note(secret, name)[0]}})
     if report_success(response):
-        note = response.json()['message']
-        name, content = decrypt_note(user.shared_secret[0], note['name'], note['message'])
-        user.notes[name] = content
+        user.notes.pop(name, None)
+        return True
+    return False
 
 
-def edit(args):
+async def delete(args):
+    """Deletes the notes concurrently."""
     user = users[current_username]
-    name, content = encrypt_note(user.shared_secret[0], args.note_name, args.content)
-    response = requests.post(ADDRESS + 'edit_note',
-                             headers={'Authorization': f'Bearer {user.jwt}'},
-                             json={
-                                 'name': name,
-                                 'message': content
-                             },
-                             proxies=MITM_PROXY)
-    check_response(response, edit, args)
-    if report_success(response):
-        note = response.json()['message']
-        name, content = decrypt_note(user.shared_secret[0], note['name'], note['message'])
-        user.notes[name] = content
+    results = await asyncio.gather(*(delete_note(user, name) for name in args.note_names))
+    user.save()
+    return all(results)
+
+
+async def import_batch(user, directory, paths):
+    """Creates a note from each file and returns how many of them were created, or None if the request failed."""
+    batch = {}
+    for path in paths:
+        with open(os.path.join(directory, path)) as f:
+            batch[os.path.splitext(path)[0]] = f.read()
+    response = await client.request(user, 'POST', 'notes/batch',
+                                    encode=lambda secret: {'json': {'notes': [
+                                        dict(zip(('name', 'message'), encrypt_note(secret, name, content)),
+                                             tokens=user.tokens(content))
+                                        for name, content in batch.items()
+                                    ]}})
+    if not report_success(response):
+        return None
+    imported = 0
+    for (name, content), result in zip(batch.items(), response.json()['message']):
+        if result['status'] == 'created':
+            user.notes[name] = content
+            imported += 1
+        else:
+            print(f'{name}: {result["status"]}')
+    return imported
 
 
-def delete(args):
+async def import_notes(args):
+    """Creates a note from every file of a directory, sending several batches at once."""
     user = users[current_username]
-    name, content = encrypt_note(user.shared_secret[0], args.note_name, user.notes[args.note_name])
-    response = requests.delete(ADDRESS + 'delete_note',
-                               headers={'Authorization': f'Bearer {user.jwt}'},
-                               json={
-                                   'name': name,
-                                   'message': content
-                               },
-                               proxies=MITM_PROXY)
-    check_response(response, delete, args)
-    if report_success(response):
-        del user.notes[args.note_name]
+    paths = sorted(path for path in os.listdir(args.directory) if os.path.isfile(os.path.join(args.directory, path)))
+    results = await asyncio.gather(*(import_batch(user, args.directory, paths[start:start + args.batch_size])
+                                     for start in range(0, len(paths), args.batch_size)))
+    user.save()
+    imported = sum(result for result in results if result is not None)
+    print(f'Imported {imported} of {len(paths)} notes')
+    return None not in results
 
 
-def print_p(args):
+async def search(args):
+    """Finds the notes containing every word, downloading only the matches."""
     user = users[current_username]
+    tokens = sorted(set(token for word in args.words for token in search_tokens(user.search_key, word)))
+    if not tokens:
+        print('Error: nothing to search for')
+        return False
+    found, params = {}, {'token': tokens, 'limit': MAX_NOTES_PAGE_SIZE}
+    while True:
+        response = await client.request(user, 'GET', 'search_notes', params=params)
+        if not report_success(response):
+            return False
+        body = response.json()
+        if not isinstance(body['message'], list):
+            print(body['message'])
+            return False
+        for note in body['message']:
+            name, content = decrypt_note(user.shared_secret[0], note['name'], note['message'])
+            found[name] = content
+        if body['next_cursor'] is None:
+            break
+        params['cursor'] = body['next_cursor']
+    user.notes.update(found)
+    print('Matching notes:', ', '.join(sorted(found)))
+    return True
+
+
+async def print_p(args):
+    user = users[current_username]
+    if args.note_name in user.notes and user.notes[args.note_name] is None:
+        print(f'Large note, download it with: save {shlex.quote(args.note_name)} <path>')
+        return True
     print(user.notes.get(args.note_name, 'Error: no note with this name'))
+    return args.note_name in user.notes
+
+
+async def exit_p(args):
+    sys.exit(0)
 
 
 COMMANDS = {
@@ -142,9 +350,13 @@ COMMANDS = {
     'create': (argparse.ArgumentParser(prog='create', exit_on_error=False), create),
     'edit': (argparse.ArgumentParser(prog='edit', exit_on_error=False), edit),
     'get': (argparse.ArgumentParser(prog='get', exit_on_error=False), get_notes),
+    'import': (argparse.ArgumentParser(prog='import', exit_on_error=False), import_notes),
     'print': (argparse.ArgumentParser(prog='print', exit_on_error=False), print_p),
     'delete': (argparse.ArgumentParser(prog='delete', exit_on_error=False), delete),
-    'exit': (argparse.ArgumentParser(prog='exit', exit_on_error=False), lambda _: sys.exit(0)),
+    'save': (argparse.ArgumentParser(prog='save', exit_on_error=False), save),
+    'search': (argparse.ArgumentParser(prog='search', exit_on_error=False), search),
+    'watch': (argparse.ArgumentParser(prog='watch', exit_on_error=False), watch),
+    'exit': (argparse.ArgumentParser(prog='exit', exit_on_error=False), exit_p),
 }
 
 
@@ -159,34 +371,115 @@ def make_commands():
 
     create = COMMANDS['create'][0]
     create.add_argument('note_name')
-    create.add_argument('content')
+    create_content = create.add_mutually_exclusive_group(required=True)
+    create_content.add_argument('content', nargs='?')
+    create_content.add_argument('--file', help='stream the content from a file of any size')
 
     edit = COMMANDS['edit'][0]
     edit.add_argument('note_name')
-    edit.add_argument('content')
+    edit_content = edit.add_mutually_exclusive_group(required=True)
+    edit_content.add_argument('content', nargs='?')
+    edit_content.add_argument('--file', help='stream the content from a file of any size')
+
+    import_notes = COMMANDS['import'][0]
+    import_notes.add_argument('directory')
+    import_notes.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE,
+                              help='notes per request; smaller batches are sent more in parallel')
 
     print_p = COMMANDS['print'][0]
     print_p.add_argument('note_name')
 
     delete = COMMANDS['delete'][0]
-    delete.add_argument('note_name')
-
-
-def main():
-    make_commands()
+    delete.add_argument('note_names', nargs='+')
+
+    save = COMMANDS['save'][0]
+    save.add_argument('note_name')
+    save.add_argument('path')
+
+    search = COMMANDS['search'][0]
+    search.add_argument('words', nargs='+')
+
+    watch = COMMANDS['watch'][0]
+    watch.add_argument('--seconds', type=float, help='stop after this long instead of running until interrupted')
+
+
+async def run_command(line):
+    """Runs one command line and returns whether it succeeded."""
+    command = shlex.split(line)
+    if command[0] not in COMMANDS:
+        print('Available commands:', *COMMANDS.keys())
+        return False
+
+    parser, callback = COMMANDS[command[0]]
+    try:
+        args = parser.parse_args(command[1:])
+    except SystemExit:
+        return False
+    if callback not in (register, login, exit_p) and current_username is None:
+        print('Error: login first')
+        return False
+    try:
+        return await callback(args)
+    except HandshakeFailed:
+        print('Handshake failed')
+    except (httpx.HTTPError, websockets.WebSocketException, ConnectionError) as e:
+        print(f'Error: {e!r}')
+    return False
+
+
+async def interactive():
     while True:
         print('>>> ', end='')
-        command = shlex.split(input())
-        if command[0] not in COMMANDS:
-            print('Available commands:', *COMMANDS.keys())
-            continue
-
-        parser, callback = COMMANDS[command[0]]
         try:
-            args = parser.parse_args(command[1:])
-        except SystemExit:
+            line = input()
+        except EOFError:
+            return True
+        if line.strip():
+            await run_command(line)
+
+
+async def script(lines, keep_going):
+    """Runs commands one per line, skipping blank lines and # comments, and stops at the first failure."""
+    ok = True
+    for line in lines:
+        if not line.strip() or line.lstrip().startswith('#'):
             continue
-        callback(args)
+        print('>>>', line.strip())
+        if not await run_command(line):
+            ok = False
+            if not keep_going:
+                break
+    return ok
+
+
+async def run(args):
+    global client
+    client = Client(concurrency=args.concurrency)
+    try:
+        if args.commands:
+            return await script(args.commands, args.keep_going)
+        if args.script is None:
+            return await interactive()
+        if args.script == '-':
+            return await script(sys.stdin, args.keep_going)
+        with open(args.script) as f:
+            return await script(f, args.keep_going)
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Client of the end-to-end encrypted notes service. '
+                                                 'Without a script it reads commands interactively.')
+    parser.add_argument('script', nargs='?', help='file of commands, one per line, or - to read them from stdin')
+    parser.add_argument('-c', dest='commands', action='append', metavar='COMMAND',
+                        help='run this command (can be repeated) instead of a script')
+    parser.add_argument('--keep-going', action='store_true', help='run the remaining commands after a failure')
+    parser.add_argument('--concurrency', type=int, default=CLI_CONCURRENCY,
+                        help='requests in flight at once (default %(default)s)')
+    args = parser.parse_args()
+    make_commands()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
 
 
 if __name__ == '__main__':
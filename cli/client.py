@@ -0,0 +1,164 @@
+"""Async HTTP core of the CLI.
+
+A Client keeps one pool of keep-alive connections to the backend, through
+MITM_PROXY, so commands reuse connections instead of opening one per
+request.  Requests may be in flight concurrently, at most CLI_CONCURRENCY of
+them at a time.  The handshake is repeated shortly before the server would
+expire it; a request the server still answers with "handshake required" is
+encrypted again and retried once after a new handshake.  The user's keypair
+stays the same across handshakes, so requests already encrypted when another
+request refreshes the handshake remain valid.
+
+Client.channel() opens the /ws/notes WebSocket (src.channel), which is not
+sent through MITM_PROXY.
+"""
+import asyncio
+import contextlib
+import json
+import re
+import time
+
+import httpx
+import websockets
+
+from crypto.ecc import ladder_mult
+from crypto.encoding import decode_point, encode_point
+from src.settings import ADDRESS, CLI_CONCURRENCY, CLI_TIMEOUT, KEY_EXPIRATION_TIME, MITM_PROXY
+
+# Seconds before the server expires a handshake at which the client repeats it.
+REFRESH_MARGIN = 60
+_ANY = object()
+
+
+class HandshakeFailed(Exception):
+    pass
+
+
+def handshake_required(response):
+    return (response.status_code == 200 and response.headers.get('Content-Type') == 'application/json'
+            and response.json().get('message') == 'handshake required')
+
+
+class Client:
+    def __init__(self, address=ADDRESS, proxies=MITM_PROXY, concurrency=CLI_CONCURRENCY):
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        mounts = {f'{scheme}://': httpx.AsyncHTTPTransport(proxy=httpx.Proxy(url), limits=limits)
+                  for scheme, url in proxies.items()}
+        self.address = address
+        self.http = httpx.AsyncClient(base_url=address, mounts=mounts, limits=limits, timeout=CLI_TIMEOUT)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.handshakes = 0
+        self._handshake_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def post(self, path, **kwargs):
+        """Sends a request that needs no login, such as register or login."""
+        async with self.slots:
+            return await self.http.post(path, **kwargs)
+
+    async def handshake(self, user, stale=_ANY):
+        """Agrees on a new shared secret with the server, unless it was renewed since stale was read."""
+        async with self._handshake_lock:
+            if stale is not _ANY and user.shared_secret is not stale:
+                return True
+            async with self.slots:
+                response = await self.http.request('GET', 'get_public_key',
+                                                   json={'public_key': encode_point(user.public_key)},
+                                                   headers=user.headers())
+            if response.status_code != 200 or 'public_key' not in response.json():
+                return False
+            user.shared_secret = ladder_mult(user.private_key, decode_point(response.json()['public_key']))
+            user.key_expires = time.monotonic() + KEY_EXPIRATION_TIME - REFRESH_MARGIN
+            self.handshakes += 1
+            return True
+
+    async def shared_secret(self, user):
+        """Returns the shared secret, repeating the handshake first if it is about to expire."""
+        secret = user.shared_secret
+        if secret is None or time.monotonic() >= user.key_expires:
+            await self.handshake(user, stale=secret)
+        if user.shared_secret is None:
+            raise HandshakeFailed()
+        return user.shared_secret
+
+    async def request(self, user, method, path, encode=None, stream=False, **kwargs):
+        """Sends a request as user and returns the response.
+
+        encode(shared_secret) returns the keyword arguments that depend on
+        the shared secret, such as an encrypted body; they are built again
+        if the request has to be repeated after a handshake.  A streamed
+        response must be closed with aclose().
+        """
+        headers = dict(user.headers(), **kwargs.pop('headers', {}))
+        for attempt in range(2):
+            secret = await self.shared_secret(user)
+            # Encrypt only once a connection is free, so that waiting requests hold no encrypted bodies.
+            async with self.slots:
+                arguments = dict(kwargs, **encode(secret[0])) if encode is not None else kwargs
+                request = self.http.build_request(method, path, headers=headers, **arguments)
+                response = await self.http.send(request, stream=stream)
+            if response.headers.get('Content-Type') == 'application/json':
+                await response.aread()
+            if attempt or not handshake_required(response):
+                return response
+            await response.aclose()
+            await self.handshake(user, stale=secret)
+
+    @contextlib.asynccontextmanager
+    async def channel(self, user):
+        """Opens a /ws/notes channel authenticated as user."""
+        url = re.sub('^http', 'ws', self.address) + 'ws/notes'
+        async with websockets.connect(url, extra_headers=user.headers()) as websocket:
+            channel = Channel(websocket)
+            try:
+                yield channel
+            finally:
+                channel.reader.cancel()
+
+
+class Channel:
+    """Client end of /ws/notes.
+
+    Frames are sent as soon as they are requested, so any number of them can
+    be in flight; replies are matched to requests by id.  The changed event
+    is set whenever the server announces a change of the user's notes.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.changed = asyncio.Event()
+        self.reader = asyncio.create_task(self._read())
+        self._replies = {}
+        self._next_id = 0
+
+    async def request(self, op, **fields):
+        self._next_id += 1
+        request_id = self._next_id
+        reply = self._replies[request_id] = asyncio.get_running_loop().create_future()
+        await self.websocket.send(json.dumps(dict(fields, id=request_id, op=op)))
+        return await reply
+
+    async def handshake(self, user):
+        """Agrees on the channel's shared secret; with the user's keypair it is the same one as over HTTP."""
+        reply = await self.request('handshake', public_key=encode_point(user.public_key))
+        if 'public_key' not in reply:
+            return False
+        user.shared_secret = ladder_mult(user.private_key, decode_point(reply['public_key']))
+        return True
+
+    async def _read(self):
+        try:
+            async for frame in self.websocket:
+                message = json.loads(frame)
+                if message.get('event') == 'changed':
+                    self.changed.set()
+                elif message.get('id') in self._replies:
+                    self._replies.pop(message['id']).set_result(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for reply in self._replies.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError('the channel was closed'))
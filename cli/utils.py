@@ -1,24 +1,90 @@
-import zpp_serpent
+import hashlib
+import hmac
+import json
+import os
+import re
+
+from crypto import cipher
 
 
 def encrypt_note(shared_secret, name, content=None):
     password = shared_secret.to_bytes(32, 'big')
-    name = str(zpp_serpent.encrypt_CFB(name.encode(), password))
+    name = cipher.encrypt_text(name, password)
     if content is not None:
-        content = str(zpp_serpent.encrypt_CFB(content.encode(), password))
+        content = cipher.encrypt_text(content, password)
     return name, content
 
 
-def decrypt_note(shared_secret, name, content):
+def decrypt_note(shared_secret, name, content=None):
     password = shared_secret.to_bytes(32, 'big')
-    name = str(zpp_serpent.decrypt_CFB(eval(name), password).decode())
-    content = str(zpp_serpent.decrypt_CFB(eval(content), password).decode())
+    name = cipher.decrypt_text(name, password)
+    if content is not None:
+        content = cipher.decrypt_text(content, password)
     return name, content
 
 
+SEARCH_KEY_ROUNDS = 100000
+
+
+def derive_search_key(username, password):
+    """Derives the key of the user's search tokens; it never leaves the client."""
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), f'evernote-search:{username}'.encode(), SEARCH_KEY_ROUNDS)
+
+
+def search_tokens(key, text):
+    """Returns the blind-index tokens of the distinct lowercase words in text."""
+    words = set(re.findall(r'\w+', text.lower()))
+    return sorted(hmac.new(key, word.encode(), hashlib.sha256).hexdigest()[:32] for word in words)
+
+
+async def encrypt_file(shared_secret, path, chunk_size):
+    """Yields the ciphertext of a file piece by piece, reading chunk_size bytes at a time."""
+    encryptor = cipher.CFBEncryptor(shared_secret.to_bytes(32, 'big'))
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            yield encryptor.update(data)
+    yield encryptor.finalize()
+
+
+async def decrypt_to_file(shared_secret, pieces, path):
+    """Decrypts an async iterable of ciphertext pieces into a file, replacing it only once the whole ciphertext
+    checks out."""
+    decryptor = cipher.CFBDecryptor(shared_secret.to_bytes(32, 'big'))
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            async for data in pieces:
+                f.write(decryptor.update(data))
+            f.write(decryptor.finalize())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def load_state(path, key):
+    """Returns the state saved by save_state, or None if it is missing or the key does not open it."""
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(cipher.decrypt_raw(f.read(), key))
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(path, key, state):
+    """Encrypts state under key and replaces the file at path atomically."""
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    # Named per process, so that sessions of the same user, such as a watch, do not write into each other's file.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        f.write(cipher.encrypt_raw(json.dumps(state), key))
+    os.replace(tmp_path, path)
+
+
 def report_success(response, expected_code=200):
     ok = response.status_code == expected_code
-    if 'message' in response.json() and response.json()['message'] == 'ECDH error':
+    body = response.json()
+    if 'message' in body and body['message'] == 'ECDH error':
         print('ECDH error')
         return False
     else:
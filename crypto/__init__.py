@@ -1,4 +0,0 @@
-import random
-
-
-random.seed(42)
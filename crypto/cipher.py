@@ -0,0 +1,70 @@
+"""Serpent-CFB backend selected by the SERPENT_BACKEND environment variable.
+
+``fast`` is the bitsliced engine in crypto.serpent, ``zpp`` is the original
+zpp_serpent package.  Both produce the same bytes, so they can be switched
+freely.  Notes too large to hold in memory go through CFBEncryptor and
+CFBDecryptor, which always come from crypto.serpent since zpp_serpent has no
+incremental API.
+"""
+import importlib
+import os
+
+from crypto import compression
+from crypto.encoding import decode_ciphertext, encode_ciphertext
+from crypto.serpent import BLOCK_SIZE, CFBDecryptor, CFBEncryptor, restore_padding
+
+SERPENT_BACKENDS = {
+    'fast': 'crypto.serpent',
+    'zpp': 'zpp_serpent',
+}
+
+
+def load_backend(name=None):
+    """Returns the module providing encrypt_CFB and decrypt_CFB."""
+    name = name or os.getenv('SERPENT_BACKEND', 'fast')
+    if name not in SERPENT_BACKENDS:
+        raise ValueError(f'unknown Serpent backend {name!r}, expected one of {", ".join(SERPENT_BACKENDS)}')
+    return importlib.import_module(SERPENT_BACKENDS[name])
+
+
+backend = load_backend()
+encrypt_CFB = backend.encrypt_CFB
+decrypt_CFB = backend.decrypt_CFB
+
+
+def encrypt_text(text, password, compact=True):
+    """Encrypts a string and returns the ciphertext in its wire encoding.
+
+    Only v1 (compact) clients understand compressed plaintexts, so legacy
+    ciphertexts are never compressed.
+    """
+    data = text.encode()
+    if compact:
+        data = compression.compress(data)
+    return encode_ciphertext(encrypt_CFB(data, password), compact)
+
+
+def decompress(plaintext):
+    """Decompresses a decrypted plaintext, repairing compressed ones written before compression.END."""
+    try:
+        return compression.decompress(plaintext)
+    except ValueError:
+        if plaintext[:1] not in (bytes([compression.ZLIB]), bytes([compression.ZSTD])):
+            raise
+    # Such a plaintext lost its tail to decrypt_CFB only if it filled whole blocks.
+    size = len(plaintext) + BLOCK_SIZE - len(plaintext) % BLOCK_SIZE
+    return compression.decompress(restore_padding(plaintext, size))
+
+
+def decrypt_text(ciphertext, password):
+    """Inverse of encrypt_text, accepting both wire encodings."""
+    return decompress(decrypt_CFB(decode_ciphertext(ciphertext), password)).decode()
+
+
+def encrypt_raw(text, password):
+    """Encrypts a string into raw ciphertext bytes for storage, compressed if that pays off."""
+    return encrypt_CFB(compression.compress(text.encode()), password)
+
+
+def decrypt_raw(ciphertext, password):
+    return decompress(decrypt_CFB(ciphertext, password)).decode()
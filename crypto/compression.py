@@ -0,0 +1,120 @@
+"""Optional compression of note plaintexts before Serpent-CFB.
+
+A compressed plaintext starts with a format byte from 0xF8-0xFF, which never
+begins valid UTF-8, so uncompressed text written by older versions still
+decodes as is.  It ends with the byte 0x80: Serpent-CFB, like zpp_serpent,
+strips anything that looks like padding from the last block on decryption,
+even when none was added, and 0x80 never does.  Formats 0xFF and 0xFE,
+written without it, are still read.  The codec used for new plaintexts is selected by the
+NOTE_COMPRESSION environment variable; every known format is accepted when
+reading.  ``zstd`` needs the optional zstandard package.
+
+Only inline notes are compressed.  Content streamed through /notes/content
+is stored in chunks as it arrives, uncompressed, and an inline note read
+through /notes/content is decompressed before it is sent, so that endpoint
+always carries the plain content.
+"""
+import os
+import zlib
+
+ZLIB = 0xFF
+ZSTD = 0xFE
+FORMAT_BYTES = range(0xF8, 0x100)
+# Format bytes of the same codecs with END after their output.
+FRAMED = {ZLIB: 0xFD, ZSTD: 0xFC}
+_UNFRAMED = {framed: format for format, framed in FRAMED.items()}
+END = b'\x80'
+
+
+class _Zlib:
+    format = ZLIB
+
+    @staticmethod
+    def compress(data):
+        return zlib.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size + 1)
+        if len(result) > max_size or not decompressor.eof:
+            raise ValueError('compressed plaintext is truncated or too large')
+        return result
+
+
+class _Zstd:
+    format = ZSTD
+
+    def __init__(self):
+        import zstandard
+        self._compressor = zstandard.ZstdCompressor()
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        result = b''
+        with self._decompressor.stream_reader(data) as reader:
+            while len(result) <= max_size:
+                piece = reader.read(max_size + 1 - len(result))
+                if not piece:
+                    break
+                result += piece
+        if len(result) > max_size:
+            raise ValueError('compressed plaintext is too large')
+        return result
+
+
+CODECS = {
+    'none': None,
+    'zlib': _Zlib,
+    'zstd': _Zstd,
+}
+
+
+def load_codec(name=None):
+    """Returns the codec that compresses new plaintexts, or None to store them as they are."""
+    name = name or os.getenv('NOTE_COMPRESSION', 'zlib')
+    if name not in CODECS:
+        raise ValueError(f'unknown compression {name!r}, expected one of {", ".join(CODECS)}')
+    return CODECS[name] and CODECS[name]()
+
+
+codec = load_codec()
+# Plaintexts shorter than this are not worth a compression header.
+threshold = int(os.getenv('NOTE_COMPRESSION_THRESHOLD', 128))
+# Bounds the output of decompress, so a small ciphertext cannot expand without limit.
+max_size = int(os.getenv('NOTE_MAX_DECOMPRESSED_SIZE', 64 * 1024 * 1024))
+_decoders = {ZLIB: _Zlib()}
+
+
+def compress(data, codec=codec, threshold=threshold):
+    """Returns data compressed between a format byte and END if that makes it shorter."""
+    if codec is None or len(data) < threshold:
+        return data
+    packed = bytes([FRAMED[codec.format]]) + codec.compress(data) + END
+    return packed if len(packed) < len(data) else data
+
+
+def decompress(data):
+    """Inverse of compress for every known format."""
+    if not data or data[0] not in FORMAT_BYTES:
+        return data
+    if data[0] in _UNFRAMED:
+        if not data.endswith(END):
+            raise ValueError('compressed plaintext is truncated')
+        data = bytes([_UNFRAMED[data[0]]]) + data[1:-1]
+    if data[0] == ZSTD and ZSTD not in _decoders:
+        try:
+            _decoders[ZSTD] = _Zstd()
+        except ImportError:
+            raise ValueError('zstd plaintexts need the zstandard package') from None
+    if data[0] not in _decoders:
+        raise ValueError(f'unknown compression format 0x{data[0]:02x}')
+    try:
+        return _decoders[data[0]].decompress(data[1:])
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f'corrupt compressed plaintext: {e}') from e
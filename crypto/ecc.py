@@ -1,22 +1,63 @@
+"""Elliptic curve arithmetic over the curve selected by the ECC_CURVE environment variable.
+
+``toy`` is the original 71-element teaching curve; ``secp256k1`` and ``P-256``
+are production-size curves.  Both ends of a handshake must use the same curve.
+"""
 import collections
+import os
+from functools import lru_cache
 
 
 EllipticCurve = collections.namedtuple('EllipticCurve', 'name p a b g n h')
 
-curve = EllipticCurve(
-    'E71(0, 7)',
-    # Field characteristic.
-    p=71,
-    # Curve coefficients.
-    a=0,
-    b=7,
-    # Base point (you can choose any point from elliptic group)
-    g=(40, 65),
-    # Subgroup order.
-    n=7,
-    # Subgroup cofactor.
-    h=10,
-)
+CURVES = {
+    'toy': EllipticCurve(
+        'E71(0, 7)',
+        # Field characteristic.
+        p=71,
+        # Curve coefficients.
+        a=0,
+        b=7,
+        # Base point (you can choose any point from elliptic group)
+        g=(40, 65),
+        # Subgroup order.
+        n=7,
+        # Subgroup cofactor.
+        h=10,
+    ),
+    'secp256k1': EllipticCurve(
+        'secp256k1',
+        p=0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffefffffc2f,
+        a=0,
+        b=7,
+        g=(0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
+           0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8),
+        n=0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141,
+        h=1,
+    ),
+    'P-256': EllipticCurve(
+        'P-256',
+        p=0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+        # -3 modulo p.
+        a=0xffffffff00000001000000000000000000000000fffffffffffffffffffffffc,
+        b=0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+        g=(0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+           0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5),
+        n=0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551,
+        h=1,
+    ),
+}
+
+
+def load_curve(name=None):
+    """Returns the registered curve called name, by default the one named by ECC_CURVE."""
+    name = name or os.getenv('ECC_CURVE', 'secp256k1')
+    if name not in CURVES:
+        raise ValueError(f'unknown curve {name!r}, expected one of {", ".join(CURVES)}')
+    return CURVES[name]
+
+
+curve = load_curve()
 
 
 # Modular arithmetic ##########################################################
@@ -52,22 +93,108 @@ def inverse_mod(k, p):
     return x % p
 
 
-def sqrt_mod(value, m):
-    for x in range(0, m):
-        if (x ** 2) % m == value:
-            yield x
+def inverse_mod_batch(values, p):
+    """Returns the inverses of all values modulo p using a single inverse_mod.
 
+    Montgomery's trick: invert the product of the values, then peel the
+    individual inverses off it with multiplications.
+    """
+    prefix = []
+    product = 1
+    for value in values:
+        prefix.append(product)
+        product = product * value % p
+
+    inverse = inverse_mod(product, p)
+    result = [0] * len(prefix)
+    for i in range(len(prefix) - 1, -1, -1):
+        result[i] = inverse * prefix[i] % p
+        inverse = inverse * values[i] % p
+    return result
+
+
+# Moduli up to this size get a table of square roots, built once in O(m);
+# larger ones use Tonelli-Shanks for every value.
+RESIDUE_TABLE_LIMIT = 1 << 22
 
-def generate_group(a, b, m):
-    group = []
 
+def sqrt_mod(value, m):
+    """Yields the square roots of value modulo the prime m in increasing order."""
+    if not 0 <= value < m:
+        return
+    if value == 0 or m == 2:
+        yield value
+        return
+
+    if m <= RESIDUE_TABLE_LIMIT:
+        root = _residue_table(m)[value]
+        if not root:
+            return
+    elif pow(value, (m - 1) // 2, m) != 1:
+        # Euler's criterion: value is not a quadratic residue.
+        return
+    else:
+        root = _tonelli_shanks(value, m)
+
+    yield min(root, m - root)
+    yield max(root, m - root)
+
+
+@lru_cache(maxsize=8)
+def _residue_table(m):
+    """Returns a list mapping every quadratic residue modulo m to its smaller root, others to 0."""
+    table = [0] * m
+    for x in range(m // 2, 0, -1):
+        table[x * x % m] = x
+    return table
+
+
+def _tonelli_shanks(value, p):
+    """Returns a square root of the quadratic residue value modulo the odd prime p."""
+    if p % 4 == 3:
+        return pow(value, (p + 1) // 4, p)
+
+    # p - 1 = q * 2^s with q odd.
+    q, s = p - 1, 0
+    while q % 2 == 0:
+        q //= 2
+        s += 1
+
+    z = 2
+    while pow(z, (p - 1) // 2, p) != p - 1:
+        z += 1
+
+    c = pow(z, q, p)
+    t = pow(value, q, p)
+    root = pow(value, (q + 1) // 2, p)
+    while t != 1:
+        i, t2 = 0, t
+        while t2 != 1:
+            t2 = t2 * t2 % p
+            i += 1
+        b = pow(c, 1 << (s - i - 1), p)
+        s, c = i, b * b % p
+        t = t * c % p
+        root = root * b % p
+    return root
+
+
+def iter_group(a, b, m):
+    """Lazily yields the points of y^2 = x^3 + ax + b over F_m, ordered by x then y.
+
+    Points with x = 0 or y = 0 are skipped, as generate_group always has.
+    """
     for x in range(1, m):
-        value = (x ** 3 + a * x + b) % m
+        value = (x * x * x + a * x + b) % m
         for y in sqrt_mod(value, m):
             if y > 0:
-                group.append((x, y))
+                yield x, y
 
-    return set(sorted(group))
+
+@lru_cache(maxsize=16)
+def generate_group(a, b, m):
+    """Returns the points of iter_group as a frozenset, cached per curve parameters."""
+    return frozenset(iter_group(a, b, m))
 
 
 # Functions that work on curve points #########################################
@@ -83,6 +210,20 @@ def is_on_curve(point):
     return (y * y - x * x * x - curve.a * x - curve.b) % curve.p == 0
 
 
+def check_point(point):
+    """Returns point if it is a point of the curve with reduced coordinates, else raises ValueError.
+
+    Points from outside, such as client public keys, must pass this before
+    any secret scalar multiplies them: the asserts of the arithmetic below
+    disappear under ``python -O``, and an off-curve point would leak bits of
+    the scalar (invalid curve attack).
+    """
+    x, y = point
+    if not (0 <= x < curve.p and 0 <= y < curve.p and is_on_curve(point)):
+        raise ValueError(f'point is not on curve {curve.name}')
+    return point
+
+
 def point_neg(point):
     """Returns -point."""
     assert is_on_curve(point)
@@ -136,7 +277,11 @@ def point_add(point1, point2):
 
 
 def scalar_mult(k, point):
-    """Returns k * point computed using the double and point_add algorithm."""
+    """Returns k * point computed using double-and-add in Jacobian coordinates.
+
+    The point is validated once here; the loop itself never leaves Jacobian
+    coordinates and a single modular inversion converts the result back.
+    """
     assert is_on_curve(point)
 
     if k % curve.n == 0 or point is None:
@@ -146,6 +291,100 @@ def scalar_mult(k, point):
         # k * point = -k * (-point)
         return scalar_mult(-k, point_neg(point))
 
+    x, y = point
+    result = None
+
+    for bit in bin(k)[2:]:
+        result = _jacobian_double(result)
+        if bit == '1':
+            result = _jacobian_add_affine(result, x, y)
+
+    result = _from_jacobian(result)
+
+    assert is_on_curve(result)
+
+    return result
+
+
+def ladder_mult(k, point):
+    """Returns k * point with a Montgomery ladder, for secret scalars.
+
+    Every bit up to the width of curve.n costs one addition and one doubling
+    whatever its value. This is not constant time: while r0 is None the
+    additions and doublings return early, which reveals the position of the
+    highest set bit, and Python's big-integer arithmetic takes time that
+    depends on its operands.
+    """
+    assert is_on_curve(point)
+
+    if k % curve.n == 0 or point is None:
+        return None
+
+    if k < 0:
+        # k * point = -k * (-point)
+        return ladder_mult(-k, point_neg(point))
+
+    r0, r1 = None, _to_jacobian(point)
+    for i in range(max(k.bit_length(), curve.n.bit_length()) - 1, -1, -1):
+        if (k >> i) & 1:
+            r0, r1 = _jacobian_add(r0, r1), _jacobian_double(r1)
+        else:
+            r0, r1 = _jacobian_double(r0), _jacobian_add(r0, r1)
+
+    result = _from_jacobian(r0)
+
+    assert is_on_curve(result)
+
+    return result
+
+
+def base_mult(k):
+    """Returns k * curve.g using a precomputed fixed-base window table.
+
+    The table holds j * 2^(w*i) * g for every window i and digit j, so the
+    product is a sum of one table entry per window with no doublings.
+    """
+    table = _fixed_table(curve, curve.g)
+    if _fixed_table_covers(table, k):
+        return _from_jacobian(_fixed_mult_jacobian(table, k))
+    return scalar_mult(k, curve.g)
+
+
+def multi_scalar_mult(terms):
+    """Returns the sum of k * point over the (k, point) pairs in terms.
+
+    Straus's method: all scalars are scanned together, a window of bits at a
+    time, so the terms share a single chain of doublings and the result needs
+    a single inversion.  Multiples of curve.g go through the fixed-base table.
+    """
+    return _from_jacobian(_multi_mult_jacobian(terms, {curve.g}))
+
+
+def multi_scalar_mult_batch(term_lists):
+    """Returns multi_scalar_mult(terms) for every entry of term_lists.
+
+    Points that occur in at least FIXED_BASE_THRESHOLD sums get a cached
+    fixed-base table like curve.g, every other point a cached window table,
+    and all sums are converted back to affine form with one inversion.
+    """
+    term_lists = [list(terms) for terms in term_lists]
+    counts = collections.Counter(point for terms in term_lists for _, point in terms)
+    fixed = {point for point, count in counts.items() if count >= FIXED_BASE_THRESHOLD}
+    fixed.add(curve.g)
+    return _batch_from_jacobian([_multi_mult_jacobian(terms, fixed) for terms in term_lists])
+
+
+def scalar_mult_affine(k, point):
+    """Reference double-and-add in affine coordinates, kept to cross-check scalar_mult."""
+    assert is_on_curve(point)
+
+    if k % curve.n == 0 or point is None:
+        return None
+
+    if k < 0:
+        # k * point = -k * (-point)
+        return scalar_mult_affine(-k, point_neg(point))
+
     result = None
     addend = point
 
@@ -162,3 +401,203 @@ def scalar_mult(k, point):
     assert is_on_curve(result)
 
     return result
+
+
+# Jacobian coordinates ########################################################
+#
+# (X, Y, Z) represents the affine point (X / Z^2, Y / Z^3); None is the point
+# at infinity.  These helpers skip curve checks and work modulo curve.p.
+
+def _jacobian_double(point):
+    if point is None:
+        return None
+
+    x, y, z = point
+    p = curve.p
+    if y == 0:
+        return None
+
+    yy = y * y % p
+    s = 4 * x * yy % p
+    m = 3 * x * x
+    if curve.a:
+        m += curve.a * pow(z, 4, p)
+    m %= p
+    x3 = (m * m - 2 * s) % p
+    y3 = (m * (s - x3) - 8 * yy * yy) % p
+    z3 = 2 * y * z % p
+    return x3, y3, z3
+
+
+def _jacobian_add(point1, point2):
+    if point1 is None:
+        return point2
+    if point2 is None:
+        return point1
+
+    x1, y1, z1 = point1
+    x2, y2, z2 = point2
+    p = curve.p
+
+    z1z1 = z1 * z1 % p
+    z2z2 = z2 * z2 % p
+    u1 = x1 * z2z2 % p
+    u2 = x2 * z1z1 % p
+    s1 = y1 * z2 * z2z2 % p
+    s2 = y2 * z1 * z1z1 % p
+
+    if u1 == u2:
+        if s1 != s2:
+            # point1 + (-point1) = 0
+            return None
+        return _jacobian_double(point1)
+
+    h = (u2 - u1) % p
+    r = (s2 - s1) % p
+    hh = h * h % p
+    hhh = h * hh % p
+    v = u1 * hh % p
+    x3 = (r * r - hhh - 2 * v) % p
+    y3 = (r * (v - x3) - s1 * hhh) % p
+    z3 = h * z1 * z2 % p
+    return x3, y3, z3
+
+
+def _jacobian_add_affine(point1, x2, y2):
+    """Adds the affine point (x2, y2) to a Jacobian point."""
+    if point1 is None:
+        return x2, y2, 1
+
+    x1, y1, z1 = point1
+    p = curve.p
+
+    z1z1 = z1 * z1 % p
+    u2 = x2 * z1z1 % p
+    s2 = y2 * z1 * z1z1 % p
+
+    if x1 == u2:
+        if y1 != s2:
+            return None
+        return _jacobian_double(point1)
+
+    h = (u2 - x1) % p
+    r = (s2 - y1) % p
+    hh = h * h % p
+    hhh = h * hh % p
+    v = x1 * hh % p
+    x3 = (r * r - hhh - 2 * v) % p
+    y3 = (r * (v - x3) - y1 * hhh) % p
+    z3 = h * z1 % p
+    return x3, y3, z3
+
+
+BASE_WINDOW = 4
+# Uses of one point in a multi_scalar_mult_batch call before it gets a
+# fixed-base table, which costs about as much as that many multiplications.
+FIXED_BASE_THRESHOLD = 16
+
+
+@lru_cache(maxsize=16)
+def _fixed_table(curve, point):
+    """Returns rows of j * 2^(w*i) * point for every window i of curve.n, in affine form."""
+    windows = -(-curve.n.bit_length() // BASE_WINDOW)
+    multiples = []
+    base = _to_jacobian(point)
+    for _ in range(windows):
+        multiple = None
+        for _ in range(1, 1 << BASE_WINDOW):
+            multiple = _jacobian_add(multiple, base)
+            multiples.append(multiple)
+        base = _jacobian_add(multiple, base)
+
+    affine = _batch_from_jacobian(multiples)
+    step = (1 << BASE_WINDOW) - 1
+    return [[None] + affine[i:i + step] for i in range(0, len(affine), step)]
+
+
+def _fixed_table_covers(table, k):
+    return k > 0 and not k >> (len(table) * BASE_WINDOW) and k % curve.n != 0
+
+
+def _fixed_mult_jacobian(table, k):
+    mask = (1 << BASE_WINDOW) - 1
+    result = None
+    for row in table:
+        digit = k & mask
+        if digit and row[digit] is not None:
+            result = _jacobian_add_affine(result, *row[digit])
+        k >>= BASE_WINDOW
+    return result
+
+
+@lru_cache(maxsize=256)
+def _window_table(curve, point):
+    """Returns [None, P, 2P, ..., (2^w - 1)P] in affine form."""
+    multiples = []
+    multiple = None
+    for _ in range(1, 1 << BASE_WINDOW):
+        multiple = _jacobian_add_affine(multiple, *point)
+        multiples.append(multiple)
+    return [None] + _batch_from_jacobian(multiples)
+
+
+def _multi_mult_jacobian(terms, fixed):
+    """Straus's method over terms; points in fixed use _fixed_table when it covers k."""
+    result = None
+    windowed = []
+    for k, point in terms:
+        assert is_on_curve(point)
+        if k % curve.n == 0 or point is None:
+            continue
+        if point in fixed:
+            table = _fixed_table(curve, point)
+            if _fixed_table_covers(table, k):
+                result = _jacobian_add(result, _fixed_mult_jacobian(table, k))
+                continue
+        if k < 0:
+            k, point = -k, point_neg(point)
+        windowed.append((k, _window_table(curve, point)))
+
+    mask = (1 << BASE_WINDOW) - 1
+    windows = -(-max((k.bit_length() for k, _ in windowed), default=0) // BASE_WINDOW)
+    straus = None
+    for shift in range((windows - 1) * BASE_WINDOW, -1, -BASE_WINDOW):
+        for _ in range(BASE_WINDOW):
+            straus = _jacobian_double(straus)
+        for k, table in windowed:
+            digit = (k >> shift) & mask
+            if digit and table[digit] is not None:
+                straus = _jacobian_add_affine(straus, *table[digit])
+
+    return _jacobian_add(result, straus)
+
+
+def _to_jacobian(point):
+    if point is None:
+        return None
+    return point[0], point[1], 1
+
+
+def _from_jacobian(point):
+    if point is None:
+        return None
+
+    x, y, z = point
+    z_inv = inverse_mod(z, curve.p)
+    z_inv2 = z_inv * z_inv % curve.p
+    return x * z_inv2 % curve.p, y * z_inv2 * z_inv % curve.p
+
+
+def _batch_from_jacobian(points):
+    """Converts Jacobian points to affine form with one shared inversion."""
+    inverses = iter(inverse_mod_batch([point[2] for point in points if point is not None], curve.p))
+    result = []
+    for point in points:
+        if point is None:
+            result.append(None)
+            continue
+        x, y, _ = point
+        z_inv = next(inverses)
+        z_inv2 = z_inv * z_inv % curve.p
+        result.append((x * z_inv2 % curve.p, y * z_inv2 * z_inv % curve.p))
+    return result
@@ -1,10 +1,10 @@
-import random
-from crypto.ecc import scalar_mult, curve
+import secrets
+from crypto.ecc import base_mult, curve
 
 
 def make_keypair():
     """Generates a random private-public key pair."""
-    private_key = random.randrange(1, curve.n)
-    public_key = scalar_mult(private_key, curve.g)
+    private_key = secrets.randbelow(curve.n - 1) + 1
+    public_key = base_mult(private_key)
 
     return private_key, public_key
@@ -1,6 +1,7 @@
 import hashlib
-import random
-from crypto.ecc import scalar_mult, curve, inverse_mod, point_add
+import secrets
+from crypto.ecc import (base_mult, curve, inverse_mod, inverse_mod_batch, is_on_curve,
+                        multi_scalar_mult_batch)
 
 
 def hash_message(message):
@@ -24,8 +25,8 @@ def sign_message(private_key, message):
     s = 0
 
     while not r or not s:
-        k = random.randrange(1, curve.n)
-        x, y = scalar_mult(k, curve.g)
+        k = secrets.randbelow(curve.n - 1) + 1
+        x, y = base_mult(k)
 
         r = x % curve.n
         s = ((z + r * private_key) * inverse_mod(k, curve.n)) % curve.n
@@ -34,18 +35,34 @@ def sign_message(private_key, message):
 
 
 def verify_signature(public_key, message, signature):
-    z = hash_message(message)
-
-    r, s = signature
-
-    w = inverse_mod(s, curve.n)
-    u1 = (z * w) % curve.n
-    u2 = (r * w) % curve.n
-
-    x, y = point_add(scalar_mult(u1, curve.g),
-                     scalar_mult(u2, public_key))
-
-    if (r % curve.n) == (x % curve.n):
-        return 'signature matches'
-    else:
+    if verify_batch([(public_key, message, signature)]):
         return 'invalid signature'
+    return 'signature matches'
+
+
+def verify_batch(items):
+    """Verifies (public_key, message, signature) triples and returns the indices that fail.
+
+    Each u1 * g + u2 * public_key is computed with one Straus pass that reuses
+    the fixed-base table for g and a cached table per public key, and the s
+    and Z inversions are shared across the whole batch.
+    """
+    failed = []
+    checks = []
+    for index, (public_key, message, (r, s)) in enumerate(items):
+        if public_key is None or not is_on_curve(public_key) or s % curve.n == 0:
+            failed.append(index)
+            continue
+        checks.append((index, hash_message(message), r, s, public_key))
+
+    inverses = inverse_mod_batch([s for _, _, _, s, _ in checks], curve.n)
+    term_lists = [
+        (((z * w) % curve.n, curve.g), ((r * w) % curve.n, public_key))
+        for (_, z, r, _, public_key), w in zip(checks, inverses)
+    ]
+
+    for (index, _, r, _, _), point in zip(checks, multi_scalar_mult_batch(term_lists)):
+        if point is None or (r % curve.n) != (point[0] % curve.n):
+            failed.append(index)
+
+    return sorted(failed)
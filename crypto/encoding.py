@@ -0,0 +1,47 @@
+"""Wire encodings for ciphertexts and curve points.
+
+Version 1 ciphertexts are ``v1:`` followed by unpadded base64url, and points
+are ``v1:<x>:<y>`` with hex coordinates.  The legacy encodings, ``str(bytes)``
+and ``str((x, y))``, are still accepted and parsed without ``eval``.  Decoded
+points are checked to lie on the curve.
+"""
+import base64
+import codecs
+
+from crypto.ecc import check_point
+
+WIRE_PREFIX = 'v1:'
+
+
+def is_compact(text):
+    return text is not None and text.startswith(WIRE_PREFIX)
+
+
+def encode_ciphertext(data, compact=True):
+    if not compact:
+        return str(data)
+    return WIRE_PREFIX + base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def decode_ciphertext(text):
+    if is_compact(text):
+        payload = text[len(WIRE_PREFIX):]
+        return base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+    if len(text) >= 3 and text[0] == 'b' and text[1] in '\'"' and text[-1] == text[1]:
+        return codecs.escape_decode(text[2:-1])[0]
+    raise ValueError('malformed ciphertext')
+
+
+def encode_point(point, compact=True):
+    if not compact:
+        return str(point)
+    x, y = point
+    return f'{WIRE_PREFIX}{x:x}:{y:x}'
+
+
+def decode_point(text):
+    if is_compact(text):
+        x, y = text[len(WIRE_PREFIX):].split(':')
+        return check_point((int(x, 16), int(y, 16)))
+    x, y = text.strip().strip('()').split(',')
+    return check_point((int(x), int(y)))
@@ -0,0 +1,355 @@
+"""Bitsliced Serpent, byte-compatible with zpp_serpent.
+
+The rounds are table-free: every S-box is evaluated as the XOR of AND-monomials
+of its algebraic normal form, so the same code runs on one block or on many
+blocks packed side by side into 32-bit lanes of a Python integer.  CFB
+decryption uses that to push all keystream blocks of a message through the
+cipher at once.  CFBEncryptor and CFBDecryptor apply the same modes to a
+message that arrives in pieces, with one difference: a stream always ends
+with a padded block, a whole block of padding if the message fills its
+blocks.  encrypt_CFB pads nothing in that case, but decrypt_CFB strips a
+tail that looks like padding all the same, so it loses the last bytes of
+such messages that happen to end like padding.  Streams carry arbitrary
+file bytes and are not read by zpp_serpent, so they do not keep that quirk.
+
+zpp_serpent stores bits LSB-first in strings built from MSB-first bytes, so
+every 32-bit word it sees is the bit-reversal of the big-endian word on the
+wire; ``_REVERSE`` converts between the two representations.
+"""
+import hashlib
+import os
+from functools import lru_cache
+
+IV_SIZE = 16
+KEY_SIZE = 32
+SALT_SIZE = 16
+BLOCK_SIZE = 16
+PBKDF2_ROUNDS = 100000
+PHI = 0x9e3779b9
+ROUNDS = 32
+
+SBOXES = (
+    (3, 8, 15, 1, 10, 6, 5, 11, 14, 13, 4, 2, 7, 0, 9, 12),
+    (15, 12, 2, 7, 9, 0, 5, 10, 1, 11, 14, 8, 6, 13, 3, 4),
+    (8, 6, 7, 9, 3, 12, 10, 15, 13, 1, 14, 4, 0, 11, 5, 2),
+    (0, 15, 11, 8, 12, 9, 6, 3, 13, 1, 2, 4, 10, 7, 5, 14),
+    (1, 15, 8, 3, 12, 0, 11, 6, 2, 5, 4, 10, 9, 14, 7, 13),
+    (15, 5, 2, 11, 4, 10, 9, 12, 0, 3, 14, 8, 13, 6, 7, 1),
+    (7, 2, 12, 5, 8, 4, 6, 11, 14, 9, 1, 15, 13, 3, 10, 0),
+    (1, 13, 15, 0, 14, 8, 2, 11, 7, 4, 12, 10, 9, 3, 5, 6),
+)
+
+_REVERSE = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+
+# S-boxes in algebraic normal form #############################################
+
+def _anf(sbox):
+    """Returns, for each output bit, the input monomials XORed to produce it.
+
+    A monomial is a 4-bit mask of the input bits ANDed together; mask 0 is the
+    constant 1.
+    """
+    terms = []
+    for bit in range(4):
+        coefficients = [(sbox[x] >> bit) & 1 for x in range(16)]
+        # Moebius transform of the truth table.
+        for i in range(4):
+            for x in range(16):
+                if x & (1 << i):
+                    coefficients[x] ^= coefficients[x ^ (1 << i)]
+        terms.append(tuple(m for m in range(16) if coefficients[m]))
+    return tuple(terms)
+
+
+def _inverse(sbox):
+    inverse = [0] * 16
+    for x, y in enumerate(sbox):
+        inverse[y] = x
+    return tuple(inverse)
+
+
+_SBOX_ANF = tuple(_anf(sbox) for sbox in SBOXES)
+_INVERSE_SBOX_ANF = tuple(_anf(_inverse(sbox)) for sbox in SBOXES)
+
+
+def _apply_sbox(anf, x0, x1, x2, x3, ones):
+    """Applies an S-box to four bitsliced words."""
+    inputs = (x0, x1, x2, x3)
+    monomials = [ones]
+    for m in range(1, 16):
+        high = m.bit_length() - 1
+        monomials.append(monomials[m ^ (1 << high)] & inputs[high] if m & (m - 1) else inputs[high])
+
+    out = []
+    for terms in anf:
+        y = 0
+        for m in terms:
+            y ^= monomials[m]
+        out.append(y)
+    return out
+
+
+# Lane arithmetic ##############################################################
+
+@lru_cache(maxsize=64)
+def _lanes(n):
+    """Returns the helpers for n 32-bit lanes: (ones, replicate, low_masks)."""
+    replicate = int.from_bytes(b'\x01\x00\x00\x00' * n, 'little')
+    ones = 0xffffffff * replicate
+    low_masks = tuple(((1 << s) - 1) * replicate for s in range(33))
+    return ones, replicate, low_masks
+
+
+def _rotl(x, s, ones, low):
+    return ((x << s) & (ones ^ low[s])) | ((x >> (32 - s)) & low[s])
+
+
+def _shl(x, s, ones, low):
+    return (x << s) & (ones ^ low[s])
+
+
+def _linear_transform(x0, x1, x2, x3, ones, low):
+    x0 = _rotl(x0, 13, ones, low)
+    x2 = _rotl(x2, 3, ones, low)
+    x1 ^= x0 ^ x2
+    x3 ^= x2 ^ _shl(x0, 3, ones, low)
+    x1 = _rotl(x1, 1, ones, low)
+    x3 = _rotl(x3, 7, ones, low)
+    x0 ^= x1 ^ x3
+    x2 ^= x3 ^ _shl(x1, 7, ones, low)
+    x0 = _rotl(x0, 5, ones, low)
+    x2 = _rotl(x2, 22, ones, low)
+    return x0, x1, x2, x3
+
+
+def _inverse_linear_transform(x0, x1, x2, x3, ones, low):
+    x2 = _rotl(x2, 10, ones, low)
+    x0 = _rotl(x0, 27, ones, low)
+    x2 ^= x3 ^ _shl(x1, 7, ones, low)
+    x0 ^= x1 ^ x3
+    x3 = _rotl(x3, 25, ones, low)
+    x1 = _rotl(x1, 31, ones, low)
+    x3 ^= x2 ^ _shl(x0, 3, ones, low)
+    x1 ^= x0 ^ x2
+    x2 = _rotl(x2, 29, ones, low)
+    x0 = _rotl(x0, 19, ones, low)
+    return x0, x1, x2, x3
+
+
+# Key schedule #################################################################
+
+@lru_cache(maxsize=256)
+def make_subkeys(key):
+    """Returns the 33 round keys for a 256-bit key as tuples of four words."""
+    if len(key) != KEY_SIZE:
+        raise ValueError(f'Serpent key must be {KEY_SIZE} bytes long')
+    reversed_key = key.translate(_REVERSE)
+    w = [int.from_bytes(reversed_key[i:i + 4], 'little') for i in range(0, KEY_SIZE, 4)]
+    for i in range(132):
+        t = w[i] ^ w[i + 3] ^ w[i + 5] ^ w[i + 7] ^ PHI ^ i
+        w.append(((t << 11) | (t >> 21)) & 0xffffffff)
+    w = w[8:]
+
+    ones = 0xffffffff
+    return tuple(
+        tuple(_apply_sbox(_SBOX_ANF[(3 - i) % 8], *w[4 * i:4 * i + 4], ones))
+        for i in range(ROUNDS + 1)
+    )
+
+
+@lru_cache(maxsize=256)
+def _lane_subkeys(key, n):
+    replicate = _lanes(n)[1]
+    return tuple(tuple(word * replicate for word in subkey) for subkey in make_subkeys(key))
+
+
+# Block functions ##############################################################
+
+def _pack(data, n):
+    """Splits n 16-byte blocks into four lane words."""
+    data = data.translate(_REVERSE)
+    return [
+        int.from_bytes(b''.join(data[b + 4 * k:b + 4 * k + 4] for b in range(0, 16 * n, 16)), 'little')
+        for k in range(4)
+    ]
+
+
+def _unpack(words, n):
+    columns = [word.to_bytes(4 * n, 'little') for word in words]
+    return b''.join(
+        b''.join(column[4 * b:4 * b + 4] for column in columns) for b in range(n)
+    ).translate(_REVERSE)
+
+
+def encrypt_blocks(data, key):
+    """Encrypts a multiple of 16 bytes in ECB mode, all blocks in parallel."""
+    if len(data) % BLOCK_SIZE:
+        raise ValueError('data must be a multiple of the block size')
+    n = len(data) // BLOCK_SIZE
+    if not n:
+        return b''
+    ones, _, low = _lanes(n)
+    subkeys = _lane_subkeys(key, n)
+    x0, x1, x2, x3 = _pack(data, n)
+
+    for i in range(ROUNDS):
+        k0, k1, k2, k3 = subkeys[i]
+        x0, x1, x2, x3 = _apply_sbox(_SBOX_ANF[i % 8], x0 ^ k0, x1 ^ k1, x2 ^ k2, x3 ^ k3, ones)
+        if i < ROUNDS - 1:
+            x0, x1, x2, x3 = _linear_transform(x0, x1, x2, x3, ones, low)
+    k0, k1, k2, k3 = subkeys[ROUNDS]
+    return _unpack((x0 ^ k0, x1 ^ k1, x2 ^ k2, x3 ^ k3), n)
+
+
+def decrypt_blocks(data, key):
+    """Decrypts a multiple of 16 bytes in ECB mode, all blocks in parallel."""
+    if len(data) % BLOCK_SIZE:
+        raise ValueError('data must be a multiple of the block size')
+    n = len(data) // BLOCK_SIZE
+    if not n:
+        return b''
+    ones, _, low = _lanes(n)
+    subkeys = _lane_subkeys(key, n)
+    x0, x1, x2, x3 = _pack(data, n)
+
+    k0, k1, k2, k3 = subkeys[ROUNDS]
+    x0, x1, x2, x3 = x0 ^ k0, x1 ^ k1, x2 ^ k2, x3 ^ k3
+    for i in range(ROUNDS - 1, -1, -1):
+        if i < ROUNDS - 1:
+            x0, x1, x2, x3 = _inverse_linear_transform(x0, x1, x2, x3, ones, low)
+        k0, k1, k2, k3 = subkeys[i]
+        x0, x1, x2, x3 = _apply_sbox(_INVERSE_SBOX_ANF[i % 8], x0, x1, x2, x3, ones)
+        x0, x1, x2, x3 = x0 ^ k0, x1 ^ k1, x2 ^ k2, x3 ^ k3
+    return _unpack((x0, x1, x2, x3), n)
+
+
+# zpp_serpent compatible modes #################################################
+
+def _pad_byte(count):
+    # zpp_serpent writes the decimal pad length and reads it back as hex.
+    return int(str(count).zfill(2), 16)
+
+
+def _pad(block):
+    count = BLOCK_SIZE - len(block)
+    return block + bytes([_pad_byte(count)]) * count
+
+
+def _unpad(block):
+    for count in range(2 * BLOCK_SIZE, 0, -1):
+        if block.endswith(bytes([_pad_byte(count)]) * count):
+            return block[:-count]
+    return block
+
+
+def restore_padding(data, size):
+    """Returns a plaintext of size bytes, a whole number of blocks, as it was before decrypt_CFB shortened it.
+
+    Such plaintexts are encrypted without padding, but decrypt_CFB strips a
+    tail that looks like padding all the same, as zpp_serpent does.
+    """
+    if size % BLOCK_SIZE or not size - BLOCK_SIZE <= len(data) < size:
+        return data
+    whole = len(data) - len(data) % BLOCK_SIZE
+    return data[:whole] + _pad(data[whole:])
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def _derive(userKey, salt, hash_type):
+    derived = hashlib.pbkdf2_hmac(hash_type, userKey, salt, PBKDF2_ROUNDS, dklen=IV_SIZE + KEY_SIZE)
+    return derived[:IV_SIZE], derived[IV_SIZE:]
+
+
+def encrypt_CFB(plainText, userKey, hash_type='sha256'):
+    salt = os.urandom(SALT_SIZE)
+    iv, key = _derive(userKey, salt, hash_type)
+    result = [encrypt_blocks(salt, hashlib.sha256(userKey).digest())]
+
+    for i in range(0, len(plainText), BLOCK_SIZE):
+        block = plainText[i:i + BLOCK_SIZE]
+        if len(block) != BLOCK_SIZE:
+            block = _pad(block)
+        iv = _xor(block, encrypt_blocks(iv, key))
+        result.append(iv)
+    return b''.join(result)
+
+
+def decrypt_CFB(cipherText, userKey, hash_type='sha256'):
+    body = cipherText[SALT_SIZE:]
+    if not body or len(body) % BLOCK_SIZE:
+        raise ValueError('ciphertext is not a whole number of blocks')
+    salt = decrypt_blocks(cipherText[:SALT_SIZE], hashlib.sha256(userKey).digest())
+    iv, key = _derive(userKey, salt, hash_type)
+
+    # Every keystream input is already known, so encrypt them in one batch.
+    result = _xor(body, encrypt_blocks(iv + body[:-BLOCK_SIZE], key))
+    return result[:-BLOCK_SIZE] + _unpad(result[-BLOCK_SIZE:])
+
+
+class CFBEncryptor:
+    """Incremental encrypt_CFB that always pads the last block.
+
+    update() outputs joined with finalize() equal encrypt_CFB(data), or
+    encrypt_CFB(data + a block of padding) when data fills whole blocks.
+    """
+
+    def __init__(self, userKey, hash_type='sha256'):
+        salt = os.urandom(SALT_SIZE)
+        self._iv, self._key = _derive(userKey, salt, hash_type)
+        self._header = encrypt_blocks(salt, hashlib.sha256(userKey).digest())
+        self._buffer = b''
+
+    def update(self, data):
+        data = self._buffer + data
+        whole = len(data) - len(data) % BLOCK_SIZE
+        self._buffer = data[whole:]
+        result = [self._header]
+        self._header = b''
+        for i in range(0, whole, BLOCK_SIZE):
+            self._iv = _xor(data[i:i + BLOCK_SIZE], encrypt_blocks(self._iv, self._key))
+            result.append(self._iv)
+        return b''.join(result)
+
+    def finalize(self):
+        result = self._header
+        self._header = b''
+        self._iv = _xor(_pad(self._buffer), encrypt_blocks(self._iv, self._key))
+        self._buffer = b''
+        return result + self._iv
+
+
+class CFBDecryptor:
+    """Incremental decrypt_CFB; the last block is held back until finalize() strips its padding."""
+
+    def __init__(self, userKey, hash_type='sha256'):
+        self._userKey = userKey
+        self._hash_type = hash_type
+        self._iv = self._key = None
+        self._buffer = b''
+
+    def update(self, data):
+        self._buffer += data
+        if self._key is None:
+            if len(self._buffer) < SALT_SIZE:
+                return b''
+            salt = decrypt_blocks(self._buffer[:SALT_SIZE], hashlib.sha256(self._userKey).digest())
+            self._iv, self._key = _derive(self._userKey, salt, self._hash_type)
+            self._buffer = self._buffer[SALT_SIZE:]
+
+        ready = max(0, (len(self._buffer) - 1) // BLOCK_SIZE * BLOCK_SIZE)
+        body, self._buffer = self._buffer[:ready], self._buffer[ready:]
+        if not body:
+            return b''
+        result = _xor(body, encrypt_blocks(self._iv + body[:-BLOCK_SIZE], self._key))
+        self._iv = body[-BLOCK_SIZE:]
+        return result
+
+    def finalize(self):
+        if self._key is None or len(self._buffer) != BLOCK_SIZE:
+            raise ValueError('ciphertext is not a whole number of blocks')
+        block, self._buffer = self._buffer, b''
+        return _unpad(_xor(block, encrypt_blocks(self._iv, self._key)))
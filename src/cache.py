@@ -0,0 +1,201 @@
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from uuid import UUID
+
+from crypto.ecc import ladder_mult
+from crypto.encoding import decode_point
+from src.settings import (KEY_EXPIRATION_TIME, NOTE_PAYLOAD_CACHE_BYTES, SESSION_KEY_CACHE_SIZE, USER_CACHE_SIZE,
+                          USER_CACHE_TTL)
+
+
+def derive_session_password(private_key: str, public_key: str) -> bytes:
+    """Returns the Serpent password shared with the owner of public_key."""
+    shared_secret = ladder_mult(int(private_key), decode_point(public_key))
+    return shared_secret[0].to_bytes(32, 'big')
+
+
+def key_fingerprint(password: bytes) -> bytes:
+    """Identifies a session password in cache keys without storing it."""
+    return hashlib.sha256(password).digest()[:16]
+
+
+class SessionKeyCache:
+    """LRU cache of Serpent passwords derived from the ECDH handshake.
+
+    Entries are keyed by user id and are only valid for the public key they
+    were derived from, until the handshake expires.
+    """
+
+    def __init__(self, maxsize: int = SESSION_KEY_CACHE_SIZE, ttl: int = KEY_EXPIRATION_TIME):
+        self.maxsize = maxsize
+        self.ttl = timedelta(seconds=ttl)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def lookup(self, user):
+        """Returns the cached password for the user's current handshake, or None."""
+        with self._lock:
+            entry = self._entries.get(user.id)
+            if entry is not None:
+                public_key, password, expires_at = entry
+                if public_key == user.public_key and datetime.now() < expires_at:
+                    self._entries.move_to_end(user.id)
+                    self.hits += 1
+                    return password
+                del self._entries[user.id]
+            self.misses += 1
+        return None
+
+    def store(self, user, password: bytes):
+        with self._lock:
+            self._entries[user.id] = (user.public_key, password, user.pk_updated_at + self.ttl)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: UUID):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+session_keys = SessionKeyCache()
+
+
+class UserCache:
+    """Short-lived LRU cache of authenticated users keyed by the JWT subject (user id).
+
+    Entries must be invalidated whenever the user row changes.
+    """
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id: UUID):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                user, expires_at = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return user
+                del self._entries[user_id]
+            self.misses += 1
+        return None
+
+    def store(self, user):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user.id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: UUID):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = UserCache()
+
+
+class NotePayloadCache:
+    """LRU cache of note names and messages already encrypted for a session.
+
+    Keys are (note id, note version, session key fingerprint, compact), so an
+    edit or a new handshake makes old entries unreachable; invalidate() frees
+    them early.  The cache is bounded by the total length of the payloads.
+    """
+
+    def __init__(self, maxbytes: int = NOTE_PAYLOAD_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict()
+        self._keys_by_note = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += self._size(payload)
+            return payload
+
+    def store(self, key, payload):
+        size = self._size(payload)
+        if size > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = payload
+            self._keys_by_note.setdefault(key[0], set()).add(key)
+            self.bytes += size
+            while self.bytes > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, note_ids):
+        with self._lock:
+            for note_id in note_ids:
+                for key in list(self._keys_by_note.get(note_id, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_note.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'bytes': self.bytes, 'maxbytes': self.maxbytes,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0, 'bytes_saved': self.bytes_saved}
+
+    def _remove(self, key):
+        payload = self._entries.pop(key)
+        self.bytes -= self._size(payload)
+        keys = self._keys_by_note[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_note[key[0]]
+
+    @staticmethod
+    def _size(payload):
+        return sum(len(field) for field in payload)
+
+
+note_payloads = NotePayloadCache()
@@ -0,0 +1,39 @@
+"""In-process fan-out of note changes to the open /ws/notes channels of each user.
+
+The invalidation listener publishes a user's id whenever a worker commits a
+change to that user's notes, and every channel of the user open in this
+process wakes up and tells its client.  Wake-ups coalesce: a channel that
+is busy sees any number of changes as one.
+"""
+import asyncio
+from uuid import UUID
+
+
+class ChangeFeed:
+    def __init__(self):
+        self.published = 0
+        self._subscribers = {}
+
+    def subscribe(self, user_id: UUID) -> asyncio.Event:
+        event = asyncio.Event()
+        self._subscribers.setdefault(user_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, user_id: UUID, event: asyncio.Event):
+        events = self._subscribers.get(user_id)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del self._subscribers[user_id]
+
+    def publish(self, user_id: UUID):
+        self.published += 1
+        for event in self._subscribers.get(user_id, ()):
+            event.set()
+
+    def stats(self):
+        return {'users': len(self._subscribers), 'channels': sum(map(len, self._subscribers.values())),
+                'published': self.published}
+
+
+change_feed = ChangeFeed()
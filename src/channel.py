@@ -0,0 +1,203 @@
+"""The /ws/notes channel: one authenticated WebSocket carrying many note operations.
+
+A REST call authenticates its JWT, loads the user and derives the session
+password every time.  A channel does the first two once when it opens,
+from the Authorization header of the upgrade request, and derives the
+password once per handshake frame.  The password stays in the channel and
+is not stored on the user row, so each open channel has its own handshake.
+
+Every client frame is a JSON object with an "op" and an "id" that the
+reply carries back:
+
+``{"id": 1, "op": "handshake", "public_key": ...}``
+    replies with the server public key; needed first, and again once the
+    channel answers "handshake required".
+``{"id": 2, "op": "create", "name": ..., "message": ..., "tokens": [...]}``
+    and ``edit``: reply like /create_note and /edit_note.
+``{"id": 3, "op": "delete", "name": ...}``
+    replies like /delete_note.
+``{"id": 4, "op": "get", "since": 0, "limit": 100}``
+    replies like /get_notes; without since, pages through cursor.
+
+Frames are handled in the order they arrive, so a client may send many
+frames before reading any reply, even ones that depend on each other.
+Whenever a note of the user changes, through any channel, REST call or
+worker, the server pushes ``{"event": "changed"}``; the client then fetches
+the changes with get since.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect, status
+from fastapi_users.jwt import decode_jwt
+from pydantic import ValidationError
+
+from crypto.encoding import decode_point, encode_point, is_compact
+from src.cache import derive_session_password
+from src.changes import change_feed
+from src.db import CachedUserDatabase, User, async_session_maker
+from src.executor import crypto_executor
+from src.schemas import Key, Note, NoteName
+from src.service import ChannelUser, NoteService
+from src.settings import KEY_EXPIRATION_TIME, MAX_NOTES_PAGE_SIZE, NOTES_PAGE_SIZE
+from src.users import UserManager, get_jwt_strategy
+
+
+class FrameError(Exception):
+    pass
+
+
+async def authenticate(websocket: WebSocket):
+    """Returns the active user and the expiry time of the bearer token of the upgrade request, or (None, None)."""
+    scheme, _, token = websocket.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return None, None
+    strategy = get_jwt_strategy()
+    async with async_session_maker() as session:
+        user = await strategy.read_token(token, UserManager(CachedUserDatabase(session, User)))
+    if user is None or not user.is_active:
+        return None, None
+    data = decode_jwt(token, strategy.decode_key, strategy.token_audience, algorithms=[strategy.algorithm])
+    return user, data['exp']
+
+
+class NoteChannel:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.user_id = None
+        self.token_expires = None
+        self.peer = None
+        self._send_lock = asyncio.Lock()
+
+    async def run(self):
+        user, self.token_expires = await authenticate(self.websocket)
+        if user is None:
+            await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        self.user_id = user.id
+        await self.websocket.accept()
+        changed = change_feed.subscribe(self.user_id)
+        pusher = asyncio.create_task(self.push_changes(changed))
+        try:
+            while True:
+                frame = await self.websocket.receive_text()
+                if time.time() >= self.token_expires:
+                    await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                    break
+                await self.send(await self.handle(frame))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            pusher.cancel()
+            change_feed.unsubscribe(self.user_id, changed)
+
+    async def send(self, reply: dict):
+        async with self._send_lock:
+            await self.websocket.send_text(orjson.dumps(reply).decode())
+
+    async def push_changes(self, changed: asyncio.Event):
+        while True:
+            await changed.wait()
+            changed.clear()
+            await self.send({"event": "changed"})
+
+    async def handle(self, frame: str) -> dict:
+        request = None
+        try:
+            request = orjson.loads(frame)
+            if not isinstance(request, dict):
+                raise FrameError("frame must be a JSON object")
+            op = OPERATIONS.get(request.get("op"))
+            if op is None:
+                raise FrameError(f"unknown op, expected one of {', '.join(OPERATIONS)}")
+            if op is not NoteChannel.handshake and not self.handshake_valid():
+                reply = {"message": "handshake required"}
+            else:
+                reply = await op(self, request)
+        except (ValueError, ValidationError, FrameError) as e:
+            reply = {"message": "invalid frame", "detail": str(e)}
+        return {"id": request.get("id") if isinstance(request, dict) else None, **reply}
+
+    def handshake_valid(self) -> bool:
+        return (self.peer is not None
+                and datetime.now() - self.peer.pk_updated_at <= timedelta(seconds=KEY_EXPIRATION_TIME))
+
+    async def handshake(self, request: dict) -> dict:
+        key = Key(public_key=request.get("public_key"))
+        try:
+            password = await crypto_executor.run(derive_session_password, os.getenv("private_key"), key.public_key)
+        except BaseException:
+            return {"message": "ECDH error"}
+        self.peer = ChannelUser(self.user_id, key.public_key, password)
+        return {"public_key": encode_point(decode_point(os.getenv("public_key")), is_compact(key.public_key))}
+
+    async def create(self, request: dict) -> dict:
+        note = Note(**request)
+        try:
+            name, message = await NoteService.decrypt_note(self.peer, note)
+            async with async_session_maker() as session:
+                await NoteService.create_note(session, self.user_id, note.copy(update={"name": name,
+                                                                                       "message": message}))
+        except BaseException:
+            return {"message": "ECDH error"}
+        return {"message": note.dict(exclude={"tokens"})}
+
+    async def edit(self, request: dict) -> dict:
+        note = Note(**request)
+        try:
+            name, message = await NoteService.decrypt_note(self.peer, note)
+            async with async_session_maker() as session:
+                updated_note = await NoteService.update_note(session, name, message, self.user_id, note.tokens)
+        except BaseException:
+            return {"message": "ECDH error"}
+        if updated_note is None:
+            return {"message": "note not found"}
+        return {"message": note.dict(exclude={"tokens"})}
+
+    async def delete(self, request: dict) -> dict:
+        note = NoteName(**request)
+        try:
+            name, = await NoteService.decrypt_fields(self.peer, [note.name])
+            if name is None:
+                return {"message": "ECDH error"}
+            async with async_session_maker() as session:
+                deleted_id = await NoteService.delete_note(session, self.user_id, name)
+        except BaseException:
+            return {"message": "ECDH error"}
+        if deleted_id is None:
+            return {"message": "note not found"}
+        return {"message": None}
+
+    async def get(self, request: dict) -> dict:
+        limit, cursor, since = request.get("limit", NOTES_PAGE_SIZE), request.get("cursor"), request.get("since")
+        if not isinstance(limit, int) or not 1 <= limit <= MAX_NOTES_PAGE_SIZE:
+            raise FrameError(f"limit must be an integer from 1 to {MAX_NOTES_PAGE_SIZE}")
+        if not all(value is None or isinstance(value, int) and value >= 0 for value in (cursor, since)):
+            raise FrameError("cursor and since must be non-negative integers")
+        async with async_session_maker() as session:
+            if since is None:
+                notes = await NoteService.get_user_notes(session, self.user_id, limit, cursor)
+                next_cursor = notes[-1].id if len(notes) == limit else None
+            else:
+                notes = await NoteService.get_changed_notes(session, self.user_id, since, limit)
+                since = notes[-1].change_seq if notes else since
+                next_cursor = since if len(notes) == limit else None
+            try:
+                notes = await NoteService.encrypt_rows(session, self.peer, notes)
+            except BaseException:
+                return {"message": "ECDH error"}
+        if since is None:
+            return {"message": notes, "next_cursor": next_cursor}
+        return {"message": notes, "next_cursor": next_cursor, "since": since}
+
+
+OPERATIONS = {
+    "handshake": NoteChannel.handshake,
+    "create": NoteChannel.create,
+    "edit": NoteChannel.edit,
+    "delete": NoteChannel.delete,
+    "get": NoteChannel.get,
+}
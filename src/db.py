@@ -2,8 +2,13 @@ import os
 from typing import AsyncGenerator
 from fastapi import Depends
 from fastapi_users.db import SQLAlchemyUserDatabase
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from src.cache import user_cache
+from src.invalidation import notify_user_changed
+from src.metrics import db_queries
+from src.migrations import run_migrations
 from src.models import Base, User
 
 
@@ -11,12 +16,24 @@ DATABASE_URL = os.environ.get('POSTGRES_URL', "postgresql+asyncpg://postgres:pos
 
 
 engine = create_async_engine(DATABASE_URL)
+db_queries.install(engine)
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+# Advisory lock key that serializes schema creation between workers starting together.
+SCHEMA_LOCK = 0x6e6f746573
+
+
 async def create_db_and_tables():
     async with engine.begin() as conn:
+        await conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK})
         await conn.run_sync(Base.metadata.create_all)
+        await run_migrations(conn)
+
+
+def listen_dsn() -> str:
+    """Returns the database URL in the form asyncpg.connect expects."""
+    return engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
@@ -24,5 +41,36 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+class CachedUserDatabase(SQLAlchemyUserDatabase):
+    """User database that serves users authenticated by JWT from the in-process user cache."""
+
+    async def get(self, id):
+        cached = user_cache.get(id)
+        if cached is not None:
+            # Attach a copy to this request's session without reloading it.
+            return await self.session.merge(cached, load=False)
+        user = await super().get(id)
+        if user is not None:
+            user_cache.store(user)
+        return user
+
+    async def update(self, user, update_dict):
+        user_cache.invalidate(user.id)
+        user = await super().update(user, update_dict)
+        user_cache.invalidate(user.id)
+        await self.notify_changed(user.id)
+        return user
+
+    async def delete(self, user):
+        user_cache.invalidate(user.id)
+        await super().delete(user)
+        await self.notify_changed(user.id)
+
+    async def notify_changed(self, user_id):
+        """Tells the other workers to drop the user from their caches."""
+        await self.session.execute(notify_user_changed(user_id))
+        await self.session.commit()
+
+
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
-    yield SQLAlchemyUserDatabase(session, User)
+    yield CachedUserDatabase(session, User)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from src.settings import CRYPTO_CHUNK_SIZE, CRYPTO_EXECUTOR, CRYPTO_WORKERS
+
+
+def _run_chunk(func, chunk, args):
+    return [func(item, *args) for item in chunk]
+
+
+class CryptoExecutor:
+    """Runs Serpent and ECC jobs in a thread or process pool off the event loop.
+
+    Jobs must be module-level functions so that they can be pickled when a
+    process pool is used.
+    """
+
+    def __init__(self, kind: str = CRYPTO_EXECUTOR, workers: int = CRYPTO_WORKERS,
+                 chunk_size: int = CRYPTO_CHUNK_SIZE):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f'unknown crypto executor {kind!r}, expected thread or process')
+        self.kind = kind
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self._pool = None
+
+    @property
+    def pool(self) -> Executor:
+        if self._pool is None:
+            pool_class = ThreadPoolExecutor if self.kind == 'thread' else ProcessPoolExecutor
+            self._pool = pool_class(max_workers=self.workers)
+        return self._pool
+
+    async def run(self, func, *args):
+        """Runs a single job in the pool."""
+        start = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+        self.jobs += 1
+        self.busy_seconds += time.perf_counter() - start
+        return result
+
+    async def map(self, func, items, *args):
+        """Runs func(item, *args) for every item in parallel chunks, preserving order."""
+        items = list(items)
+        if not items:
+            return []
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.pool, _run_chunk, func, chunk, args) for chunk in chunks
+        ))
+        self.jobs += len(items)
+        self.busy_seconds += time.perf_counter() - start
+        return [result for chunk in results for result in chunk]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'workers': self.workers,
+            'chunk_size': self.chunk_size,
+            'jobs': self.jobs,
+            'busy_seconds': round(self.busy_seconds, 3),
+        }
+
+
+crypto_executor = CryptoExecutor()
@@ -0,0 +1,66 @@
+"""Keeps the in-process user caches of several workers coherent.
+
+Every worker has its own UserCache and SessionKeyCache, so a handshake or a
+notebook change handled by one worker must reach the caches of the others.
+Writers add notify_user_changed() to the transaction that changes the user
+row; Postgres delivers the notification on commit to every worker, whose
+listener drops its cached copies.  If a listener loses its connection its
+worker stops caching users, since it could no longer tell when they change.
+Notifications of changed notes are also passed on to the change feed.
+"""
+from uuid import UUID
+
+import asyncpg
+from sqlalchemy import func, select
+
+from src.cache import session_keys, user_cache
+from src.changes import change_feed
+
+CHANNEL = 'user_changed'
+
+
+def notify_user_changed(user_id: UUID, notes: bool = False):
+    """Returns the statement that announces a change of the user row, or of the user's notes, on commit."""
+    return select(func.pg_notify(CHANNEL, f'{user_id} notes' if notes else str(user_id)))
+
+
+class InvalidationListener:
+    def __init__(self):
+        self.received = 0
+        self.connected = False
+        self._connection = None
+
+    async def start(self, dsn: str):
+        self._connection = await asyncpg.connect(dsn)
+        await self._connection.add_listener(CHANNEL, self._on_notification)
+        self._connection.add_termination_listener(self._on_lost)
+        self.connected = True
+
+    async def stop(self):
+        if self._connection is not None:
+            self._connection.remove_termination_listener(self._on_lost)
+            await self._connection.close()
+            self._connection = None
+            self.connected = False
+
+    def _on_notification(self, connection, pid, channel, payload):
+        user_id, _, what = payload.partition(' ')
+        user_id = UUID(user_id)
+        # notes_version is on the user row; the session password only changes with the handshake.
+        user_cache.invalidate(user_id)
+        if what == 'notes':
+            change_feed.publish(user_id)
+        else:
+            session_keys.invalidate(user_id)
+        self.received += 1
+
+    def _on_lost(self, connection):
+        self.connected = False
+        user_cache.ttl = 0
+        user_cache.clear()
+
+    def stats(self):
+        return {'connected': self.connected, 'received': self.received}
+
+
+invalidation_listener = InvalidationListener()
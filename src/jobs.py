@@ -0,0 +1,347 @@
+"""Resumable background jobs that rewrite note rows in batches.
+
+Every batch runs in its own short transaction and stores its position in
+the job_checkpoint table, so a job never holds locks on more than one batch
+of rows and can be stopped and resumed at any time.  Run a single instance
+of each job at a time.
+
+Run from the repository root: python -m src.jobs ciphertext
+or, to rotate data keys at 200 rows per second: python -m src.jobs rotate --new-keys --rate 200
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import bindparam, delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from crypto import cipher
+from crypto.encoding import decode_ciphertext
+from src import models
+from src.db import async_session_maker
+from src.executor import crypto_executor
+from src.keys import data_keys, load_master_keys
+from src.server_keys import install_server_key
+from src.service import split_stream, stored_ciphertext, transcode_stream
+from src.settings import NOTE_CHUNK_SIZE
+
+
+class BatchJob:
+    name = None
+
+    def __init__(self, batch_size: int = 500, rate: float = None):
+        self.batch_size = batch_size
+        # Upper bound on rows per second, None for no throttling.
+        self.rate = rate
+        self.processed = 0
+        self.failed = 0
+        self.remaining = None
+        self.last_id = 0
+        self.running = False
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+
+    def pending(self):
+        """Returns the WHERE clause selecting the note rows that still need the job."""
+        raise NotImplementedError
+
+    def columns(self):
+        return models.Note.id, models.Note.message
+
+    async def process(self, session, rows):
+        """Rewrites one batch of rows and returns how many of them were converted."""
+        raise NotImplementedError
+
+    async def load_checkpoint(self, session):
+        checkpoint = await session.get(models.JobCheckpoint, self.name)
+        if checkpoint is None:
+            checkpoint = models.JobCheckpoint(name=self.name, last_id=0, processed=0)
+            session.add(checkpoint)
+        return checkpoint
+
+    async def run(self):
+        self.running = True
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        try:
+            async with async_session_maker() as session, session.begin():
+                checkpoint = await self.load_checkpoint(session)
+                self.last_id = checkpoint.last_id
+                stmt = select(func.count()).select_from(models.Note).where(self.pending(), models.Note.id > self.last_id)
+                self.remaining = (await session.execute(stmt)).scalar_one()
+
+            while await self.run_batch():
+                if self.rate:
+                    # Sleep until the average rate drops back under the limit.
+                    delay = self.processed / self.rate - (time.monotonic() - self.started_at)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        finally:
+            self.running = False
+            self.finished_at = time.monotonic()
+
+    async def run_batch(self):
+        async with async_session_maker() as session, session.begin():
+            stmt = (
+                select(*self.columns())
+                .where(self.pending(), models.Note.id > self.last_id)
+                .order_by(models.Note.id)
+                .limit(self.batch_size)
+            )
+            rows = (await session.execute(stmt)).all()
+            if not rows:
+                return False
+
+            converted = await self.process(session, rows)
+            checkpoint = await self.load_checkpoint(session)
+            checkpoint.last_id = rows[-1].id
+            checkpoint.processed += converted
+
+        self.last_id = rows[-1].id
+        self.processed += converted
+        self.failed += len(rows) - converted
+        self.remaining = max(0, self.remaining - len(rows))
+        return True
+
+    async def stored_progress(self, session):
+        """Returns the progress recorded in the checkpoint, for a job that is not running in this process."""
+        checkpoint = await session.get(models.JobCheckpoint, self.name)
+        last_id = checkpoint.last_id if checkpoint else 0
+        stmt = select(func.count()).select_from(models.Note).where(self.pending(), models.Note.id > last_id)
+        return {
+            'job': self.name,
+            'running': None,
+            'processed': checkpoint.processed if checkpoint else 0,
+            'remaining': (await session.execute(stmt)).scalar_one(),
+            'last_id': last_id,
+            'updated_at': checkpoint.updated_at if checkpoint else None,
+        }
+
+    def progress(self):
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0.0
+        rows_per_second = self.processed / elapsed if elapsed else 0.0
+        total = self.processed + self.failed + (self.remaining or 0)
+        return {
+            'job': self.name,
+            'running': self.running,
+            'processed': self.processed,
+            'failed': self.failed,
+            'remaining': self.remaining,
+            'last_id': self.last_id,
+            'percent': round(100 * (self.processed + self.failed) / total, 1) if total else 100.0,
+            'rows_per_second': round(rows_per_second, 1),
+        }
+
+
+class CiphertextMigration(BatchJob):
+    """Moves legacy str(bytes) at-rest ciphertexts from note.message to note.ciphertext."""
+    name = 'ciphertext'
+
+    def pending(self):
+        return models.Note.ciphertext.is_(None) & models.Note.message.isnot(None)
+
+    async def process(self, session, rows):
+        params = []
+        for note_id, message in rows:
+            try:
+                ciphertext = decode_ciphertext(message)
+            except ValueError:
+                continue
+            params.append({'b_id': note_id, 'b_ciphertext': ciphertext, 'b_length': len(ciphertext)})
+
+        if params:
+            table = models.Note.__table__
+            stmt = (
+                update(table)
+                # Rows rewritten by a concurrent edit are left alone.
+                .where(table.c.id == bindparam('b_id'), table.c.ciphertext.is_(None))
+                .values(message=None, ciphertext=bindparam('b_ciphertext'), ciphertext_length=bindparam('b_length'))
+            )
+            await session.execute(stmt, params)
+        return len(params)
+
+
+def reencrypt(item):
+    """Moves one at-rest ciphertext from its data key to another, or returns None if it does not decrypt."""
+    note, old_password, new_password = item
+    try:
+        return cipher.encrypt_CFB(cipher.decrypt_CFB(stored_ciphertext(note), old_password), new_password)
+    except ValueError:
+        return None
+
+
+class KeyRotation(BatchJob):
+    """Re-encrypts notes that are not under the newest data key of their owner.
+
+    Notes from before envelope encryption are moved to data keys the same
+    way.  A fresh run first rewraps data keys under the current master key
+    and, with new_keys, gives every user a new data key, so that the run
+    replaces all of them.  Readers pick the key by note.key_id, so notes stay
+    readable whichever key they are under.  The checkpoint is reset once a
+    run completes.
+    """
+    name = 'rotate'
+
+    def __init__(self, batch_size: int = 500, rate: float = None, new_keys: bool = False):
+        super().__init__(batch_size, rate)
+        self.new_keys = new_keys
+        self.rewrapped = 0
+        self.keys_created = 0
+
+    def pending(self):
+        note = models.Note
+        current = (
+            select(func.max(models.DataKey.id))
+            .where(models.DataKey.user_id == note.user_id)
+            .scalar_subquery()
+        )
+        stored = note.ciphertext.isnot(None) | note.message.isnot(None) | note.chunks.isnot(None)
+        return note.deleted.is_(False) & stored & (note.key_id.is_(None) | (note.key_id != current))
+
+    def columns(self):
+        note = models.Note
+        return note.id, note.user_id, note.version, note.key_id, note.message, note.ciphertext, note.chunks
+
+    async def run(self):
+        async with async_session_maker() as session, session.begin():
+            checkpoint = await self.load_checkpoint(session)
+            if checkpoint.last_id == 0:
+                self.rewrapped = await data_keys.rewrap(session)
+                if self.new_keys:
+                    users = (await session.execute(select(models.Note.user_id).distinct())).scalars().all()
+                    for user_id in users:
+                        await data_keys.create(session, user_id)
+                    self.keys_created = len(users)
+
+        await super().run()
+        async with async_session_maker() as session, session.begin():
+            checkpoint = await self.load_checkpoint(session)
+            checkpoint.last_id = 0
+
+    async def process(self, session, rows):
+        current = {}
+        for user_id in {row.user_id for row in rows}:
+            current[user_id] = await data_keys.current(session, user_id)
+        keys = await data_keys.get_many(session, [row.key_id for row in rows])
+
+        inline = [row for row in rows if row.chunks is None]
+        ciphertexts = await crypto_executor.map(
+            reencrypt, [(row, keys[row.key_id], current[row.user_id][1]) for row in inline])
+        params = [
+            {'b_id': row.id, 'b_version': row.version, 'b_key_id': current[row.user_id][0],
+             'b_ciphertext': ciphertext, 'b_length': len(ciphertext)}
+            for row, ciphertext in zip(inline, ciphertexts) if ciphertext is not None
+        ]
+        if params:
+            table = models.Note.__table__
+            stmt = (
+                update(table)
+                # Rows edited or deleted since they were read already have new ciphertext.
+                .where(table.c.id == bindparam('b_id'), table.c.version == bindparam('b_version'),
+                       table.c.deleted.is_(False))
+                .values(message=None, ciphertext=bindparam('b_ciphertext'), ciphertext_length=bindparam('b_length'),
+                        key_id=bindparam('b_key_id'))
+            )
+            await session.execute(stmt, params)
+
+        converted = len(params)
+        for row in rows:
+            if row.chunks is not None:
+                key_id, password = current[row.user_id]
+                converted += await self.reencrypt_chunks(session, row, keys[row.key_id], key_id, password)
+        return converted
+
+    async def reencrypt_chunks(self, session, row, old_password, key_id, password):
+        """Re-encrypts the chunk rows of a streamed note one chunk at a time; returns 1 if the note was converted."""
+        stmt = (
+            update(models.Note)
+            .where(models.Note.id == row.id, models.Note.version == row.version, models.Note.deleted.is_(False))
+            .values(key_id=key_id)
+            .returning(models.Note.id)
+            .execution_options(synchronize_session=False)
+        )
+        if (await session.execute(stmt)).scalar_one_or_none() is None:
+            return 0
+
+        stmt = (
+            select(models.NoteChunk.data)
+            .where(models.NoteChunk.note_id == row.id)
+            .order_by(models.NoteChunk.seq)
+            .execution_options(yield_per=1)
+        )
+        pieces = (await session.stream(stmt)).scalars()
+        decryptor = cipher.CFBDecryptor(old_password)
+        encryptor = await crypto_executor.run(cipher.CFBEncryptor, password)
+        chunks = 0
+        # Output chunk n is complete only after input chunk n was read, so rows are overwritten behind the reader.
+        async for data in split_stream(transcode_stream(pieces, decryptor, encryptor), NOTE_CHUNK_SIZE):
+            stmt = insert(models.NoteChunk).values(note_id=row.id, seq=chunks, data=data)
+            await session.execute(stmt.on_conflict_do_update(index_elements=['note_id', 'seq'],
+                                                             set_={'data': stmt.excluded.data}))
+            chunks += 1
+        await session.execute(delete(models.NoteChunk).where(models.NoteChunk.note_id == row.id,
+                                                             models.NoteChunk.seq >= chunks))
+        stmt = (
+            update(models.Note)
+            .where(models.Note.id == row.id)
+            .values(chunks=chunks)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(stmt)
+        return 1
+
+    def progress(self):
+        return {**super().progress(), 'rewrapped_keys': self.rewrapped, 'new_keys': self.keys_created}
+
+
+JOBS = {
+    CiphertextMigration.name: CiphertextMigration,
+    KeyRotation.name: KeyRotation,
+}
+
+
+# Jobs started through the API, by name; they run on the event loop of this process.
+started = {}
+
+
+def start_job(job):
+    """Starts job in the background unless a job of the same name is already running here."""
+    previous = started.get(job.name)
+    if previous is not None and previous.running:
+        return False
+    job.running = True
+    job.task = asyncio.get_running_loop().create_task(job.run())
+    started[job.name] = job
+    return True
+
+
+def stop_jobs():
+    for job in started.values():
+        if job.running:
+            job.task.cancel()
+
+
+async def run_job(job):
+    load_master_keys()
+    await install_server_key()
+    task = asyncio.create_task(job.run())
+    while not task.done():
+        await asyncio.wait([task], timeout=1)
+        print(job.progress())
+    await task
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a resumable batch job over the note table.')
+    parser.add_argument('job', choices=JOBS)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=None, help='maximum rows per second')
+    parser.add_argument('--new-keys', action='store_true', help='rotate: give every user a new data key first')
+    args = parser.parse_args()
+    options = {'new_keys': args.new_keys} if args.job == KeyRotation.name else {}
+    asyncio.run(run_job(JOBS[args.job](args.batch_size, args.rate, **options)))
+
+
+if __name__ == '__main__':
+    main()
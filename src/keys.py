@@ -0,0 +1,158 @@
+"""Envelope encryption of notes at rest.
+
+Every user has data keys, random Serpent passwords stored in the data_key
+table wrapped (CFB-encrypted) by a master key.  Notes record the id of the
+data key they were encrypted with in note.key_id, so rows written before and
+after a rotation can be read side by side; the newest data key of a user is
+the one new rows are written with.  Rows with no key_id predate envelope
+encryption and are still encrypted with the server private key.
+
+Master keys come from MASTER_KEYS as ``id:hex,...`` with the key used for
+wrapping first.  They must be set: a master key generated or stored next to
+the data would not survive a restart, or would not protect the data keys.
+Data keys wrapped with the server private key by earlier versions, under
+master key id ``server``, stay readable until the rotate job rewraps them.
+"""
+import os
+from threading import Lock
+from uuid import UUID
+
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crypto import cipher
+from crypto.serpent import restore_padding
+from src import models
+from src.executor import crypto_executor
+from src.settings import MASTER_KEYS
+
+DATA_KEY_SIZE = 32
+WRAP_TRAILER = b'\x80'
+SERVER_KEY_ID = 'server'
+
+
+def server_password() -> bytes:
+    return int(os.getenv('private_key')).to_bytes(32, 'big')
+
+
+def load_master_keys(spec: str = MASTER_KEYS):
+    """Returns ({master key id: key}, id of the key that wraps new data keys)."""
+    if not spec:
+        raise ValueError('MASTER_KEYS must be set to id:hex of a 32-byte key, e.g. '
+                         'k1:$(python -c "import os; print(os.urandom(32).hex())")')
+    keys = {}
+    for entry in spec.split(','):
+        key_id, _, key = entry.strip().partition(':')
+        keys[key_id] = bytes.fromhex(key)
+        if len(keys[key_id]) != DATA_KEY_SIZE:
+            raise ValueError(f'master key {key_id!r} must be {DATA_KEY_SIZE} bytes of hex')
+    current = spec.split(',')[0].strip().partition(':')[0]
+    if current == SERVER_KEY_ID:
+        raise ValueError(f'master key id {SERVER_KEY_ID!r} is reserved for data keys wrapped by earlier versions')
+    if 'private_key' in os.environ:
+        keys.setdefault(SERVER_KEY_ID, server_password())
+    return keys, current
+
+
+def wrap_key(key: bytes, master_key: bytes) -> bytes:
+    # The trailer is not a padding byte, so decrypt_CFB never mistakes the end of the key for padding.
+    return cipher.encrypt_CFB(key + WRAP_TRAILER, master_key)
+
+
+def unwrap_key(wrapped: bytes, master_key: bytes) -> bytes:
+    key = cipher.decrypt_CFB(wrapped, master_key)
+    if len(key) == DATA_KEY_SIZE + 1 and key.endswith(WRAP_TRAILER):
+        return key[:-1]
+    # Keys wrapped without the trailer lose a tail that looks like padding; their size tells what it was.
+    key = restore_padding(key, DATA_KEY_SIZE)
+    if len(key) != DATA_KEY_SIZE:
+        raise ValueError('wrapped data key is malformed or under another master key')
+    return key
+
+
+def unwrap_pair(pair) -> bytes:
+    return unwrap_key(*pair)
+
+
+class DataKeys:
+    """Unwraps data keys on first use and keeps them by id; a key never changes once written."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._keys = {}
+        self._lock = Lock()
+
+    async def get_many(self, session: AsyncSession, key_ids) -> dict:
+        """Returns {key id: password} for key_ids; None stands for the server private key."""
+        key_ids = set(key_ids)
+        with self._lock:
+            keys = {key_id: self._keys[key_id] for key_id in key_ids if key_id in self._keys}
+            self.hits += len(keys)
+        if None in key_ids:
+            keys[None] = server_password()
+        missing = key_ids - keys.keys()
+        if missing:
+            stmt = select(models.DataKey).where(models.DataKey.id.in_(missing))
+            rows = (await session.execute(stmt)).scalars().all()
+            master_keys, _ = load_master_keys()
+            unwrapped = await crypto_executor.map(
+                unwrap_pair, [(row.wrapped_key, master_keys[row.master_key_id]) for row in rows])
+            with self._lock:
+                for row, key in zip(rows, unwrapped):
+                    self._keys[row.id] = keys[row.id] = key
+                self.misses += len(rows)
+        return keys
+
+    async def get(self, session: AsyncSession, key_id) -> bytes:
+        return (await self.get_many(session, [key_id]))[key_id]
+
+    async def current(self, session: AsyncSession, user_id: UUID):
+        """Returns (key id, password) of the key new notes of the user are written with, creating it if needed."""
+        stmt = select(func.max(models.DataKey.id)).where(models.DataKey.user_id == user_id)
+        key_id = (await session.execute(stmt)).scalar_one_or_none()
+        if key_id is None:
+            return await self.create(session, user_id)
+        return key_id, await self.get(session, key_id)
+
+    async def create(self, session: AsyncSession, user_id: UUID):
+        """Adds a new current data key for the user; older keys stay readable."""
+        key = os.urandom(DATA_KEY_SIZE)
+        master_keys, master_key_id = load_master_keys()
+        wrapped = await crypto_executor.run(wrap_key, key, master_keys[master_key_id])
+        stmt = (
+            insert(models.DataKey)
+            .values(user_id=user_id, master_key_id=master_key_id, wrapped_key=wrapped)
+            .returning(models.DataKey.id)
+        )
+        key_id = (await session.execute(stmt)).scalar_one()
+        with self._lock:
+            self._keys[key_id] = key
+        return key_id, key
+
+    async def rewrap(self, session: AsyncSession) -> int:
+        """Wraps every data key under the current master key, so that older master keys can be retired."""
+        master_keys, master_key_id = load_master_keys()
+        stmt = select(models.DataKey).where(models.DataKey.master_key_id != master_key_id)
+        rows = (await session.execute(stmt)).scalars().all()
+        keys = await self.get_many(session, [row.id for row in rows])
+        wrapped = await crypto_executor.map(wrap_key, [keys[row.id] for row in rows], master_keys[master_key_id])
+        if rows:
+            table = models.DataKey.__table__
+            stmt = (
+                update(table)
+                .where(table.c.id == bindparam('b_id'))
+                .values(master_key_id=master_key_id, wrapped_key=bindparam('b_wrapped'))
+            )
+            await session.execute(stmt, [{'b_id': row.id, 'b_wrapped': key} for row, key in zip(rows, wrapped)])
+        return len(rows)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def stats(self):
+        return {'size': len(self._keys), 'hits': self.hits, 'misses': self.misses}
+
+
+data_keys = DataKeys()
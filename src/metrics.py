@@ -0,0 +1,103 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+_request_queries = ContextVar('request_queries', default=None)
+
+
+def percentile(samples, q):
+    """Returns the q-th percentile (0..100) of samples using nearest rank."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+class LoopLagMonitor:
+    """Measures how long the event loop is blocked.
+
+    A background task sleeps for a fixed interval; any extra delay before it
+    wakes up is time the loop spent running something else without yielding.
+    """
+
+    def __init__(self, interval: float = 0.05, window: int = 2000):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.blocked_seconds = 0.0
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _watch(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples.append(lag)
+            self.blocked_seconds += lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        samples = list(self.samples)
+        return {
+            'blocked_seconds': round(self.blocked_seconds, 3),
+            'max_lag_ms': round(self.max_lag * 1000, 2),
+            'p50_lag_ms': round(percentile(samples, 50) * 1000, 2),
+            'p99_lag_ms': round(percentile(samples, 99) * 1000, 2),
+        }
+
+
+loop_lag = LoopLagMonitor()
+
+
+class QueryCounter:
+    """Counts database statements executed while handling each HTTP request."""
+
+    def __init__(self, window: int = 2000):
+        self.requests = 0
+        self.queries = 0
+        self.samples = deque(maxlen=window)
+
+    def install(self, engine):
+        event.listen(engine.sync_engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        counter = _request_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+    @contextmanager
+    def track(self):
+        counter = [0]
+        token = _request_queries.set(counter)
+        try:
+            yield counter
+        finally:
+            _request_queries.reset(token)
+            self.requests += 1
+            self.queries += counter[0]
+            self.samples.append(counter[0])
+
+    def stats(self):
+        samples = list(self.samples)
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'queries_per_request': round(self.queries / self.requests, 2) if self.requests else 0.0,
+            'p99_queries_per_request': percentile(samples, 99),
+        }
+
+
+db_queries = QueryCounter()
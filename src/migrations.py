@@ -0,0 +1,38 @@
+"""Idempotent schema changes for databases created by older versions.
+
+``Base.metadata.create_all`` only creates missing tables, so every change to
+an existing table is listed here and applied on startup.  Each statement must
+be safe to run again.
+"""
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+MIGRATIONS = [
+    # Note names are unique per user instead of globally.
+    'ALTER TABLE note DROP CONSTRAINT IF EXISTS note_name_key',
+    # At-rest ciphertext is stored as raw bytes.
+    'ALTER TABLE note ADD COLUMN IF NOT EXISTS ciphertext BYTEA',
+    'ALTER TABLE note ADD COLUMN IF NOT EXISTS ciphertext_length INTEGER',
+    # Note versions key the encrypted payload cache.
+    'ALTER TABLE note ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1',
+    # Change sequence and tombstones for incremental sync; names are unique among live notes only.
+    'CREATE SEQUENCE IF NOT EXISTS note_change_seq',
+    "ALTER TABLE note ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('note_change_seq')",
+    'ALTER TABLE note ADD COLUMN IF NOT EXISTS deleted BOOLEAN NOT NULL DEFAULT false',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_note_user_id_name_live ON note (user_id, name) WHERE NOT deleted',
+    'DROP INDEX IF EXISTS ix_note_user_id_name',
+    'CREATE INDEX IF NOT EXISTS ix_note_user_id_change_seq ON note (user_id, change_seq)',
+    # Notebook version for conditional GETs of /get_notes.
+    'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS notes_version BIGINT NOT NULL DEFAULT 0',
+    # Streamed notes keep their ciphertext in note_chunk rows.
+    'ALTER TABLE note ADD COLUMN IF NOT EXISTS chunks INTEGER',
+    # Envelope encryption: the data key of each note; data_key itself is created by create_all.
+    'ALTER TABLE note ADD COLUMN IF NOT EXISTS key_id INTEGER REFERENCES data_key (id)',
+]
+
+
+async def run_migrations(conn: AsyncConnection):
+    if conn.dialect.name != 'postgresql':
+        return
+    for statement in MIGRATIONS:
+        await conn.execute(text(statement))
\ No newline at end of file
@@ -2,23 +2,103 @@ from datetime import datetime
 
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID
 from fastapi_users_db_sqlalchemy.generics import GUID
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import (BigInteger, Boolean, Column, Integer, String, ForeignKey, DateTime, Index, LargeBinary,
+                        Sequence, text)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
+# Orders every note change, so clients can ask for what changed since a point.
+note_change_seq = Sequence("note_change_seq", metadata=Base.metadata)
+
+
+# Unique index on the names of live notes, named so that its violations can be told apart.
+LIVE_NAME_INDEX = "ix_note_user_id_name_live"
+
 
 class Note(Base):
     __tablename__ = "note"
+    __table_args__ = (
+        # Names are unique among live notes; tombstones keep theirs.
+        Index(LIVE_NAME_INDEX, "user_id", "name", unique=True, postgresql_where=text("NOT deleted")),
+        Index("ix_note_user_id_change_seq", "user_id", "change_seq"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(GUID, ForeignKey("user.id"))
-    name = Column(String, unique=True)
+    name = Column(String)
+    # Legacy at-rest ciphertext as str(bytes), moved to ciphertext by src.jobs.
     message = Column(String)
+    ciphertext = Column(LargeBinary)
+    ciphertext_length = Column(Integer)
+    # Bumped on every edit, so cached encrypted payloads of older versions miss.
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # Set from note_change_seq on every insert, edit and delete.
+    change_seq = Column(BigInteger, nullable=False, server_default=note_change_seq.next_value())
+    # Deleted notes stay behind as tombstones without ciphertext.
+    deleted = Column(Boolean, nullable=False, default=False, server_default=text("false"))
+    # Number of note_chunk rows holding the ciphertext of a streamed note, None for inline notes.
+    chunks = Column(Integer)
+    # Data key the at-rest ciphertext is encrypted with, None for the server private key.
+    key_id = Column(Integer, ForeignKey("data_key.id"))
+
+
+class DataKey(Base):
+    """Per-user Serpent password for notes at rest, wrapped by a master key (see src.keys)."""
+    __tablename__ = "data_key"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(GUID, ForeignKey("user.id"), nullable=False, index=True)
+    master_key_id = Column(String, nullable=False)
+    wrapped_key = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class NoteChunk(Base):
+    """Consecutive slices of the single at-rest CFB ciphertext of a streamed note."""
+    __tablename__ = "note_chunk"
+
+    note_id = Column(Integer, ForeignKey("note.id", ondelete="CASCADE"), primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+
+class NoteToken(Base):
+    """Blind-index search token of a note: an HMAC of one keyword under a key only the client knows."""
+    __tablename__ = "note_token"
+    __table_args__ = (
+        Index("ix_note_token_user_id_token", "user_id", "token"),
+    )
+
+    note_id = Column(Integer, ForeignKey("note.id", ondelete="CASCADE"), primary_key=True)
+    token = Column(String, primary_key=True)
+    user_id = Column(GUID, ForeignKey("user.id"), nullable=False)
+
+
+class ServerKey(Base):
+    """Server ECDH keypair shared by all workers (see src.server_keys)."""
+    __tablename__ = "server_key"
+
+    name = Column(String, primary_key=True)
+    curve = Column(String, nullable=False)
+    private_key = Column(String, nullable=False)
+    public_key = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class JobCheckpoint(Base):
+    __tablename__ = "job_checkpoint"
+
+    name = Column(String, primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 
 class User(SQLAlchemyBaseUserTableUUID, Base):
     notes = relationship(Note, backref="user")
     public_key = Column(String)
     pk_updated_at = Column(DateTime, onupdate=datetime.now)
+    # Bumped with every note change; part of the /get_notes ETag.
+    notes_version = Column(BigInteger, nullable=False, default=0, server_default='0')
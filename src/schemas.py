@@ -1,16 +1,92 @@
 import uuid
+from typing import List, Optional, Union
 from fastapi_users import schemas
-from pydantic import BaseModel, constr
+from pydantic import BaseModel, conlist, constr, validator
+from crypto.encoding import decode_point
+from src.settings import MAX_BATCH_SIZE, MAX_INLINE_MESSAGE_LENGTH, MAX_NOTE_TOKENS
 
 
-class Note(BaseModel):
+class NoteName(BaseModel):
     name: constr(min_length=1, max_length=256)
-    message: constr(min_length=1)
+
+
+class Note(NoteName):
+    # Larger notes are streamed through /notes/content.
+    message: constr(min_length=1, max_length=MAX_INLINE_MESSAGE_LENGTH)
+    # Blind-index search tokens computed by the client; notes sent without them are not searchable.
+    tokens: Optional[conlist(constr(min_length=1, max_length=64), max_items=MAX_NOTE_TOKENS)] = None
+
+
+class NoteBatch(BaseModel):
+    notes: conlist(Note, min_items=1, max_items=MAX_BATCH_SIZE)
+
+
+class NoteNameBatch(BaseModel):
+    names: conlist(constr(min_length=1, max_length=256), min_items=1, max_items=MAX_BATCH_SIZE)
 
 
 class Key(BaseModel):
     public_key: str
 
+    @validator('public_key')
+    def point_on_curve(cls, value):
+        # Rejected before it is stored or multiplied by the server private key.
+        decode_point(value)
+        return value
+
+
+# Replies of the note endpoints.  message holds the result, or a string
+# such as "handshake required" or "ECDH error" when there is none.
+
+class Reply(BaseModel):
+    message: Optional[str]
+
+
+class NoteContent(BaseModel):
+    name: str
+    message: str
+
+
+class NoteReply(BaseModel):
+    message: Union[NoteContent, str]
+
+
+class ListedNote(BaseModel):
+    """A note of a listing with name and message encrypted for the session.
+
+    Tombstones and streamed notes have no message.
+    """
+    id: int
+    name: str
+    message: Optional[str]
+    deleted: bool
+    chunks: Optional[int]
+
+
+class NotesPage(BaseModel):
+    message: Union[List[ListedNote], str]
+    next_cursor: Optional[int]
+    # Change cursor of an incremental sync, only when the request had since.
+    since: Optional[int]
+
+
+class ChunkedNote(BaseModel):
+    name: str
+    chunks: int
+
+
+class ChunkedNoteReply(BaseModel):
+    message: Union[ChunkedNote, str]
+
+
+class NoteStatus(BaseModel):
+    name: str
+    status: str
+
+
+class BatchReply(BaseModel):
+    message: Union[List[NoteStatus], str]
+
 
 class UserRead(schemas.BaseUser[uuid.UUID]):
     pass
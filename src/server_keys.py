@@ -0,0 +1,176 @@
+"""Where the server ECDH keypair lives, so that every worker and node uses the same one.
+
+The provider is selected by SERVER_KEY_PROVIDER, by default ``kms`` if
+KMS_KEY is set and ``file`` otherwise:
+
+``kms``
+    a row of the server_key table, shared by every machine or dyno using the
+    database, with the private key sealed by a local stand-in for a key
+    management service, keyed by KMS_KEY.
+``database``
+    the same without sealing: the private key is stored in plain text, so
+    anyone with a dump of the database has it.
+``file``
+    a JSON file at SERVER_KEY_FILE, shared by the workers of one machine
+    only; each dyno of a Heroku app has its own filesystem.
+``env``
+    the private_key and public_key environment variables; a key generated
+    here lives only as long as the process.
+
+Each provider creates the keypair atomically the first time, so workers
+starting together agree on a single key.  Explicit private_key and
+public_key environment variables always take precedence.
+"""
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from crypto import cipher
+from crypto.ecc import curve
+from crypto.ecdh import make_keypair
+from crypto.encoding import encode_point
+from src import models
+from src.settings import KMS_KEY, SERVER_KEY_FILE, SERVER_KEY_PROVIDER
+
+KEY_NAME = 'ecdh'
+SEALED_KEY_NAME = 'ecdh-sealed'
+
+
+def generate_key() -> dict:
+    private_key, public_key = make_keypair()
+    return {'curve': curve.name, 'private_key': str(private_key), 'public_key': encode_point(public_key)}
+
+
+def check_curve(key: dict) -> dict:
+    if key['curve'] != curve.name:
+        raise ValueError(f'the stored server key is for curve {key["curve"]!r}, not {curve.name!r}')
+    return key
+
+
+class EnvKeyProvider:
+    name = 'env'
+
+    async def load(self) -> dict:
+        if 'private_key' in os.environ:
+            return {'curve': curve.name, 'private_key': os.environ['private_key'],
+                    'public_key': os.environ['public_key']}
+        print('keys were created for this process only; set SERVER_KEY_PROVIDER to share them')
+        return generate_key()
+
+
+class FileKeyProvider:
+    name = 'file'
+
+    def __init__(self, path: str = SERVER_KEY_FILE):
+        self.path = path
+
+    def seal(self, key: dict) -> bytes:
+        return json.dumps(key).encode()
+
+    def unseal(self, data: bytes) -> dict:
+        return json.loads(data)
+
+    async def load(self) -> dict:
+        try:
+            with open(self.path, 'rb') as f:
+                return check_curve(self.unseal(f.read()))
+        except FileNotFoundError:
+            pass
+        # Write the whole file under a private name, then link it into place: the link fails if another
+        # worker got there first, and nobody ever sees a partly written file.
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+            f.write(self.seal(generate_key()))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, self.path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+        with open(self.path, 'rb') as f:
+            return check_curve(self.unseal(f.read()))
+
+
+class LocalKms:
+    """Stand-in for a key management service: seals and unseals small secrets with a key it never exposes."""
+
+    def __init__(self, key_hex: str = KMS_KEY):
+        if not key_hex:
+            raise ValueError('KMS_KEY must be set to use the kms server key provider')
+        self._key = bytes.fromhex(key_hex)
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        return cipher.encrypt_CFB(plaintext, self._key)
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        return cipher.decrypt_CFB(ciphertext, self._key)
+
+
+class DatabaseKeyProvider:
+    name = 'database'
+    key_name = KEY_NAME
+
+    def seal(self, key: dict) -> dict:
+        return key
+
+    def unseal(self, key: dict) -> dict:
+        return key
+
+    async def load(self) -> dict:
+        # Imported here so that the other providers work without a database.
+        from src.db import async_session_maker
+
+        async with async_session_maker() as session, session.begin():
+            stmt = (
+                pg_insert(models.ServerKey)
+                .values(name=self.key_name, created_at=datetime.now(), **self.seal(generate_key()))
+                .on_conflict_do_nothing(index_elements=['name'])
+            )
+            await session.execute(stmt)
+            stmt = select(models.ServerKey).where(models.ServerKey.name == self.key_name)
+            row = (await session.execute(stmt)).scalar_one()
+            key = {'curve': row.curve, 'private_key': row.private_key, 'public_key': row.public_key}
+            return check_curve(self.unseal(key))
+
+
+class KmsKeyProvider(DatabaseKeyProvider):
+    name = 'kms'
+    key_name = SEALED_KEY_NAME
+
+    def __init__(self, kms: LocalKms = None):
+        self.kms = kms or LocalKms()
+
+    def seal(self, key: dict) -> dict:
+        return dict(key, private_key=self.kms.encrypt(key['private_key'].encode()).hex())
+
+    def unseal(self, key: dict) -> dict:
+        return dict(key, private_key=self.kms.decrypt(bytes.fromhex(key['private_key'])).decode())
+
+
+PROVIDERS = {
+    EnvKeyProvider.name: EnvKeyProvider,
+    FileKeyProvider.name: FileKeyProvider,
+    KmsKeyProvider.name: KmsKeyProvider,
+    DatabaseKeyProvider.name: DatabaseKeyProvider,
+}
+
+
+def load_provider(name: str = None):
+    """Returns the server key provider called name, by default the one named by SERVER_KEY_PROVIDER."""
+    name = name or SERVER_KEY_PROVIDER
+    if name not in PROVIDERS:
+        raise ValueError(f'unknown server key provider {name!r}, expected one of {", ".join(PROVIDERS)}')
+    if 'private_key' in os.environ:
+        return EnvKeyProvider()
+    return PROVIDERS[name]()
+
+
+async def install_server_key(provider=None):
+    """Loads the shared server keypair into this process's environment, where the handlers read it."""
+    key = await (provider or load_provider()).load()
+    os.environ['private_key'], os.environ['public_key'] = key['private_key'], key['public_key']
@@ -1,88 +1,601 @@
+import hashlib
 import os
 from datetime import datetime
+from typing import Optional
 from uuid import UUID
-import zpp_serpent
-from sqlalchemy import select
+from sqlalchemy import bindparam, delete, func, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
-from crypto.ecc import scalar_mult
+from crypto import cipher
+from crypto.encoding import decode_ciphertext, is_compact
 from src import schemas, models
+from src.cache import derive_session_password, key_fingerprint, note_payloads, session_keys, user_cache
+from src.executor import crypto_executor
+from src.invalidation import notify_user_changed
+from src.keys import data_keys
+from src.settings import NOTE_CHUNK_SIZE, NOTES_STREAM_BATCH
+
+
+# Column values of a deleted note; the name stays so clients can drop it.
+TOMBSTONE = {'deleted': True, 'message': None, 'ciphertext': None, 'ciphertext_length': None, 'chunks': None}
+
+
+def stored_ciphertext(note):
+    """Returns the at-rest ciphertext of a note row, migrated or not."""
+    if note.ciphertext is not None:
+        return note.ciphertext
+    return decode_ciphertext(note.message)
+
+
+def decrypt_at_rest(item):
+    """Returns the plaintext of an at-rest ciphertext, or None if it cannot be decrypted."""
+    ciphertext, password = item
+    try:
+        return cipher.decrypt_raw(ciphertext, password)
+    except ValueError:
+        return None
+
+
+def encrypt_or_none(text, password, compact):
+    return None if text is None else cipher.encrypt_text(text, password, compact)
+
+
+def decrypt_or_none(ciphertext, password):
+    try:
+        return cipher.decrypt_text(ciphertext, password)
+    except Exception:
+        return None
+
+
+def transcode(data, decryptor, encryptor, final=False):
+    """Decrypts a piece of one CFB stream and encrypts it into another.
+
+    The cipher states are returned with the output, so that a process pool
+    hands back the advanced copies.
+    """
+    data = decryptor.update(data)
+    if final:
+        data += decryptor.finalize()
+    data = encryptor.update(data)
+    if final:
+        data += encryptor.finalize()
+    return decryptor, encryptor, data
+
+
+def transcode_inline(ciphertext, key, password):
+    """Re-encrypts an inline note as a session stream, decompressing it, since /notes/content carries plain content."""
+    encryptor = cipher.CFBEncryptor(password)
+    return encryptor.update(cipher.decompress(cipher.decrypt_CFB(ciphertext, key))) + encryptor.finalize()
+
+
+async def transcode_stream(pieces, decryptor, encryptor):
+    """Re-encrypts an async iterable of CFB stream pieces, one executor job per piece."""
+    async for data in pieces:
+        decryptor, encryptor, data = await crypto_executor.run(transcode, data, decryptor, encryptor)
+        if data:
+            yield data
+    decryptor, encryptor, data = await crypto_executor.run(transcode, b'', decryptor, encryptor, True)
+    yield data
+
+
+async def split_stream(pieces, size):
+    """Regroups an async iterable of bytes into pieces of exactly size bytes, except the last one."""
+    buffer = b''
+    async for data in pieces:
+        buffer += data
+        while len(buffer) >= size:
+            yield buffer[:size]
+            buffer = buffer[size:]
+    if buffer:
+        yield buffer
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an ETag against an If-None-Match header."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in [tag.removeprefix('W/') for tag in tags]
 
 
 class UserService:
     @staticmethod
     async def save_public_key(session: AsyncSession, user_id: UUID, key: schemas.Key):
-        user = await session.get(models.User, {'id': user_id})
-        user.public_key = key.public_key
-        user.pk_updated_at = datetime.now()
+        stmt = (
+            update(models.User)
+            .where(models.User.id == user_id)
+            .values(public_key=key.public_key, pk_updated_at=datetime.now())
+        )
+        await session.execute(stmt)
+        await session.execute(notify_user_changed(user_id))
         await session.commit()
-        await session.refresh(user)
-        return user
+        user_cache.invalidate(user_id)
+        session_keys.invalidate(user_id)
+
+
+class ChannelUser:
+    """A user as seen by one /ws/notes channel, which keeps the password of its own handshake."""
+
+    def __init__(self, user_id: UUID, public_key: str, password: bytes):
+        self.id = user_id
+        self.public_key = public_key
+        self.password = password
+        self.pk_updated_at = datetime.now()
 
 
 class NoteService:
+    @staticmethod
+    async def session_password(user):
+        if isinstance(user, ChannelUser):
+            return user.password
+        password = session_keys.lookup(user)
+        if password is None:
+            password = await crypto_executor.run(derive_session_password, os.getenv('private_key'), user.public_key)
+            session_keys.store(user, password)
+        return password
+
+    @staticmethod
+    def notes_etag(user, *params):
+        """Returns a weak ETag for a notes listing of user with the given query parameters.
+
+        It changes with the notebook version and the handshake, and needs
+        neither the notes nor the session key.
+        """
+        state = ':'.join(str(value) for value in (user.id, user.notes_version, user.public_key, *params))
+        return f'W/"{hashlib.sha256(state.encode()).hexdigest()[:32]}"'
+
     @staticmethod
     async def decrypt_note(user, note):
-        shared_secret = scalar_mult(int(os.getenv('private_key')), eval(user.public_key))
-        password = shared_secret[0].to_bytes(32, 'big')
-        name = zpp_serpent.decrypt_CFB(eval(note.name), password).decode()
-        message = zpp_serpent.decrypt_CFB(eval(note.message), password).decode()
+        password = await NoteService.session_password(user)
+        name, message = await crypto_executor.map(cipher.decrypt_text, [note.name, note.message], password)
         return name, message
 
+    @staticmethod
+    async def decrypt_fields(user, fields):
+        """Decrypts many ciphertexts at once, returning None for the ones that fail."""
+        password = await NoteService.session_password(user)
+        return await crypto_executor.map(decrypt_or_none, fields, password)
+
+    @staticmethod
+    async def encrypt_notes(user, notes):
+        password = await NoteService.session_password(user)
+        compact = is_compact(user.public_key)
+        fields = [field for note in notes for field in (note.name, note.message)]
+        fields = await crypto_executor.map(encrypt_or_none, fields, password, compact)
+        for note, name, message in zip(notes, fields[::2], fields[1::2]):
+            note.name, note.message = name, message
+        return notes
+
+    @staticmethod
+    async def encrypt_rows(session: AsyncSession, user, rows):
+        """Returns note rows as schemas.ListedNote dicts, with name and message encrypted for the user's session.
+
+        Payloads cached for the same note version and session key are reused;
+        only the other rows are decrypted at rest and encrypted again.
+        Tombstones and streamed notes only carry their name.
+        """
+        password = await NoteService.session_password(user)
+        compact = is_compact(user.public_key)
+        fingerprint = key_fingerprint(password)
+        keys = [(row.id, row.version, fingerprint, compact) for row in rows]
+        name_only = [row.deleted or row.chunks is not None for row in rows]
+        payloads = [None if skip else note_payloads.get(key) for skip, key in zip(name_only, keys)]
+
+        missing = [i for i, payload in enumerate(payloads) if payload is None and not name_only[i]]
+        if missing:
+            notes = await NoteService.decrypt_notes_at_rest(session, [rows[i] for i in missing])
+            notes = await NoteService.encrypt_notes(user, notes)
+            for i, note in zip(missing, notes):
+                payloads[i] = (note.name, note.message)
+                note_payloads.store(keys[i], payloads[i])
+
+        named = [i for i, skip in enumerate(name_only) if skip]
+        names = await crypto_executor.map(cipher.encrypt_text, [rows[i].name for i in named], password, compact)
+        for i, name in zip(named, names):
+            payloads[i] = (name, None)
+
+        # Plain dicts of column values are much cheaper to build and serialize than ORM copies.
+        return [
+            {"id": row.id, "name": name, "message": message, "deleted": row.deleted, "chunks": row.chunks}
+            for row, (name, message) in zip(rows, payloads)
+        ]
+
     @staticmethod
     async def create_note(session: AsyncSession, user_id: UUID, note: schemas.Note):
-        user = await session.get(models.User, {'id': user_id})
-        db_password = int(os.getenv('private_key')).to_bytes(32, 'big')
-        note = models.Note(
-            user_id=user.id,
-            name=note.name,
-            message=str(zpp_serpent.encrypt_CFB(note.message.encode(), db_password))
-        )
+        key_id, password = await data_keys.current(session, user_id)
+        ciphertext = await crypto_executor.run(cipher.encrypt_raw, note.message, password)
         decrypted_note = models.Note(
-            user_id=user.id,
+            user_id=user_id,
             name=note.name,
             message=note.message
         )
-        session.add(note)
-        await session.commit()
-        await session.refresh(note)
+        row = models.Note(
+            user_id=user_id,
+            name=note.name,
+            ciphertext=ciphertext,
+            ciphertext_length=len(ciphertext),
+            key_id=key_id
+        )
+        await NoteService.lock_notebook(session, user_id)
+        session.add(row)
+        if note.tokens:
+            await session.flush()
+            await NoteService.set_tokens(session, user_id, {row.id: note.tokens}, replace=False)
+        await NoteService.commit_notebook(session, user_id)
         return decrypted_note
 
     @staticmethod
-    async def get_user_notes(session: AsyncSession, user_id: UUID):
-        stmt = select(models.User).where(models.User.id == user_id).options(selectinload(models.User.notes))
+    async def lock_notebook(session: AsyncSession, user_id: UUID):
+        """Locks the user row until the transaction ends; writers call it before drawing change_seq values.
+
+        Writes of one user then commit in change_seq order, so a sync that has
+        seen change_seq n never misses a change below n that commits later.
+        """
+        stmt = select(models.User.id).where(models.User.id == user_id).with_for_update(key_share=True)
+        await session.execute(stmt)
+
+    @staticmethod
+    async def commit_notebook(session: AsyncSession, user_id: UUID, changed: bool = True):
+        """Commits the session, bumping the user's notes_version in the same transaction if notes changed."""
+        if changed:
+            stmt = (
+                update(models.User)
+                .where(models.User.id == user_id)
+                .values(notes_version=models.User.notes_version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            await session.execute(stmt)
+            await session.execute(notify_user_changed(user_id, notes=True))
+        await session.commit()
+        if changed:
+            user_cache.invalidate(user_id)
+
+    @staticmethod
+    async def decrypt_notes_at_rest(session: AsyncSession, notes):
+        """Returns detached copies of note rows with their messages decrypted, each with its own data key.
+
+        A message that cannot be decrypted is None, so that one bad row does
+        not fail the whole page.
+        """
+        keys = await data_keys.get_many(session, [note.key_id for note in notes])
+        messages = await crypto_executor.map(decrypt_at_rest,
+                                             [(stored_ciphertext(note), keys[note.key_id]) for note in notes])
+        return [
+            models.Note(id=note.id, user_id=note.user_id, version=note.version, name=note.name, message=message)
+            for note, message in zip(notes, messages)
+        ]
+
+    @staticmethod
+    def user_notes_query(user_id: UUID, cursor: Optional[int] = None):
+        stmt = (
+            select(models.Note)
+            .where(models.Note.user_id == user_id, models.Note.deleted.is_(False))
+            .order_by(models.Note.id)
+        )
+        if cursor is not None:
+            stmt = stmt.where(models.Note.id > cursor)
+        return stmt
+
+    @staticmethod
+    async def get_changed_notes(session: AsyncSession, user_id: UUID, since: int, limit: int):
+        """Returns the user's notes and tombstones changed after the since cursor, oldest change first.
+
+        A since of 0 is a first sync, which has nothing to delete, so it skips tombstones.
+        """
+        stmt = (
+            select(models.Note)
+            .where(models.Note.user_id == user_id, models.Note.change_seq > since)
+            .order_by(models.Note.change_seq)
+            .limit(limit)
+        )
+        if since == 0:
+            stmt = stmt.where(models.Note.deleted.is_(False))
         result = await session.execute(stmt)
-        user = result.scalars().one()
-        db_password = int(os.getenv('private_key')).to_bytes(32, 'big')
-        for note in user.notes:
-            note.message = zpp_serpent.decrypt_CFB(eval(note.message), db_password).decode()
-        return user.notes
+        return result.scalars().all()
 
     @staticmethod
-    async def update_note(session: AsyncSession, note_name: str, note_message: str, user_id: UUID):
-        stmt = select(models.Note).where(models.Note.name == note_name)
-        notes = await session.execute(stmt)
-        note_from_db = notes.scalars().one()
+    async def get_user_notes(session: AsyncSession, user_id: UUID, limit: Optional[int] = None,
+                             cursor: Optional[int] = None):
+        """Returns the user's note rows, still encrypted at rest."""
+        stmt = NoteService.user_notes_query(user_id, cursor)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        result = await session.execute(stmt)
+        return result.scalars().all()
 
-        if note_from_db.user_id != user_id:
-            return "This is not your note, you can't edit it"
-        db_password = int(os.getenv('private_key')).to_bytes(32, 'big')
-        note_from_db.message = str(zpp_serpent.encrypt_CFB(note_message.encode(), db_password))
+    @staticmethod
+    async def stream_user_notes(session: AsyncSession, user_id: UUID, cursor: Optional[int] = None):
+        """Yields note rows in batches, reading them through a server-side cursor."""
+        stmt = NoteService.user_notes_query(user_id, cursor).execution_options(yield_per=NOTES_STREAM_BATCH)
+        result = await session.stream(stmt)
+        async for notes in result.scalars().partitions(NOTES_STREAM_BATCH):
+            yield notes
 
-        await session.commit()
-        await session.refresh(note_from_db)
+    @staticmethod
+    async def update_note(session: AsyncSession, note_name: str, note_message: str, user_id: UUID, tokens=None):
+        """Updates the user's note in a single statement, returning None if it does not exist."""
+        key_id, password = await data_keys.current(session, user_id)
+        ciphertext = await crypto_executor.run(cipher.encrypt_raw, note_message, password)
+        await NoteService.lock_notebook(session, user_id)
+        stmt = (
+            update(models.Note)
+            .where(models.Note.user_id == user_id, models.Note.name == note_name, models.Note.deleted.is_(False))
+            .values(message=None, ciphertext=ciphertext, ciphertext_length=len(ciphertext), chunks=None, key_id=key_id,
+                    version=models.Note.version + 1, change_seq=models.note_change_seq.next_value())
+            .returning(models.Note.id)
+            .execution_options(synchronize_session=False)
+        )
+        note_id = (await session.execute(stmt)).scalar_one_or_none()
+        if note_id is not None:
+            await NoteService.drop_chunks(session, [note_id])
+            await NoteService.set_tokens(session, user_id, {note_id: tokens})
+        await NoteService.commit_notebook(session, user_id, note_id is not None)
+        if note_id is None:
+            return None
+        note_payloads.invalidate([note_id])
         return models.Note(
+            id=note_id,
             user_id=user_id,
             name=note_name,
             message=note_message
         )
 
     @staticmethod
-    async def delete_note(session, user_id, note):
-        stmt = select(models.Note).where(models.Note.name == note.name)
-        notes = await session.execute(stmt)
-        note_from_db = notes.scalars().one()
-        if note_from_db.user_id != user_id:
-            return "This is not your note, you can't delete it"
-        await session.delete(note_from_db)
-        await session.commit()
+    async def delete_note(session: AsyncSession, user_id: UUID, note_name: str):
+        """Replaces the user's note with a tombstone in a single statement, returning its id or None."""
+        await NoteService.lock_notebook(session, user_id)
+        stmt = (
+            update(models.Note)
+            .where(models.Note.user_id == user_id, models.Note.name == note_name, models.Note.deleted.is_(False))
+            .values(**TOMBSTONE, change_seq=models.note_change_seq.next_value())
+            .returning(models.Note.id)
+            .execution_options(synchronize_session=False)
+        )
+        note_id = (await session.execute(stmt)).scalar_one_or_none()
+        if note_id is not None:
+            await NoteService.drop_chunks(session, [note_id])
+            await NoteService.set_tokens(session, user_id, {note_id: None})
+        await NoteService.commit_notebook(session, user_id, note_id is not None)
+        if note_id is not None:
+            note_payloads.invalidate([note_id])
+        return note_id
+
+    @staticmethod
+    async def existing_names(session: AsyncSession, user_id: UUID, names):
+        """Returns {name: note id} for the names the user already has notes under."""
+        stmt = select(models.Note.name, models.Note.id).where(
+            models.Note.user_id == user_id,
+            models.Note.deleted.is_(False),
+            models.Note.name.in_([name for name in names if name is not None])
+        )
+        return dict((await session.execute(stmt)).all())
+
+    @staticmethod
+    async def create_notes(session: AsyncSession, user_id: UUID, notes, tokens=None):
+        """Inserts (name, message) pairs in one transaction and returns a status for each pair.
+
+        tokens, if given, holds the search tokens of each pair.
+        """
+        tokens = tokens or [None] * len(notes)
+        taken = set(await NoteService.existing_names(session, user_id, [name for name, _ in notes]))
+        statuses, rows, tokens_by_name = [], [], {}
+        for (name, message), note_tokens in zip(notes, tokens):
+            if name is None or message is None:
+                statuses.append('ECDH error')
+            elif name in taken:
+                statuses.append('exists')
+            else:
+                taken.add(name)
+                statuses.append('created')
+                rows.append({'user_id': user_id, 'name': name, 'message': message})
+                if note_tokens:
+                    tokens_by_name[name] = note_tokens
+
+        key_id, password = await data_keys.current(session, user_id) if rows else (None, None)
+        ciphertexts = await crypto_executor.map(cipher.encrypt_raw, [row.pop('message') for row in rows], password)
+        for row, ciphertext in zip(rows, ciphertexts):
+            row['ciphertext'], row['ciphertext_length'], row['key_id'] = ciphertext, len(ciphertext), key_id
+        if rows:
+            await NoteService.lock_notebook(session, user_id)
+            await session.execute(insert(models.Note.__table__), rows)
+        if tokens_by_name:
+            ids = await NoteService.existing_names(session, user_id, tokens_by_name)
+            await NoteService.set_tokens(session, user_id, {ids[name]: tokens_by_name[name] for name in tokens_by_name},
+                                         replace=False)
+        await NoteService.commit_notebook(session, user_id, bool(rows))
+        return statuses
+
+    @staticmethod
+    async def update_notes(session: AsyncSession, user_id: UUID, notes, tokens=None):
+        """Updates (name, message) pairs in one transaction and returns a status for each pair.
+
+        tokens, if given, holds the search tokens of each pair.
+        """
+        tokens = tokens or [None] * len(notes)
+        existing = await NoteService.existing_names(session, user_id, [name for name, _ in notes])
+        statuses, rows, tokens_by_note = [], [], {}
+        for (name, message), note_tokens in zip(notes, tokens):
+            if name is None or message is None:
+                statuses.append('ECDH error')
+            elif name not in existing:
+                statuses.append('not found')
+            else:
+                statuses.append('updated')
+                rows.append({'b_user_id': user_id, 'b_name': name, 'b_message': message})
+                tokens_by_note[existing[name]] = note_tokens
+
+        key_id, password = await data_keys.current(session, user_id) if rows else (None, None)
+        ciphertexts = await crypto_executor.map(cipher.encrypt_raw, [row.pop('b_message') for row in rows], password)
+        for row, ciphertext in zip(rows, ciphertexts):
+            row['b_ciphertext'], row['b_length'] = ciphertext, len(ciphertext)
+        if rows:
+            await NoteService.lock_notebook(session, user_id)
+            table = models.Note.__table__
+            stmt = (
+                update(table)
+                .where(table.c.user_id == bindparam('b_user_id'), table.c.name == bindparam('b_name'),
+                       table.c.deleted.is_(False))
+                .values(message=None, ciphertext=bindparam('b_ciphertext'), ciphertext_length=bindparam('b_length'),
+                        chunks=None, key_id=key_id, version=table.c.version + 1,
+                        change_seq=models.note_change_seq.next_value())
+            )
+            await session.execute(stmt, rows)
+            await NoteService.drop_chunks(session, [existing[row['b_name']] for row in rows])
+            await NoteService.set_tokens(session, user_id, tokens_by_note)
+        await NoteService.commit_notebook(session, user_id, bool(rows))
+        note_payloads.invalidate(existing[row['b_name']] for row in rows)
+        return statuses
+
+    @staticmethod
+    async def delete_notes(session: AsyncSession, user_id: UUID, names):
+        """Replaces notes with tombstones by name in one transaction and returns a status for each name."""
+        existing = await NoteService.existing_names(session, user_id, names)
+        statuses, rows = [], []
+        for name in names:
+            if name is None:
+                statuses.append('ECDH error')
+            elif name not in existing:
+                statuses.append('not found')
+            else:
+                statuses.append('deleted')
+                rows.append({'b_user_id': user_id, 'b_name': name})
+
+        if rows:
+            await NoteService.lock_notebook(session, user_id)
+            table = models.Note.__table__
+            stmt = (
+                update(table)
+                .where(table.c.user_id == bindparam('b_user_id'), table.c.name == bindparam('b_name'),
+                       table.c.deleted.is_(False))
+                .values(**TOMBSTONE, change_seq=models.note_change_seq.next_value())
+            )
+            await session.execute(stmt, rows)
+            await NoteService.drop_chunks(session, [existing[row['b_name']] for row in rows])
+            await NoteService.set_tokens(session, user_id, {existing[row['b_name']]: None for row in rows})
+        await NoteService.commit_notebook(session, user_id, bool(rows))
+        note_payloads.invalidate(existing[row['b_name']] for row in rows)
+        return statuses
+
+    @staticmethod
+    async def drop_chunks(session: AsyncSession, note_ids):
+        """Deletes the chunk rows of notes whose content was replaced inline or deleted."""
+        await session.execute(delete(models.NoteChunk).where(models.NoteChunk.note_id.in_(note_ids)))
+
+    @staticmethod
+    async def set_tokens(session: AsyncSession, user_id: UUID, tokens_by_note, replace: bool = True):
+        """Stores {note id: search tokens}; notes mapped to None or [] are left unsearchable."""
+        if replace and tokens_by_note:
+            await session.execute(delete(models.NoteToken).where(models.NoteToken.note_id.in_(list(tokens_by_note))))
+        rows = [{'note_id': note_id, 'user_id': user_id, 'token': token}
+                for note_id, tokens in tokens_by_note.items() for token in set(tokens or ())]
+        if rows:
+            await session.execute(insert(models.NoteToken.__table__), rows)
+
+    @staticmethod
+    async def search_notes(session: AsyncSession, user_id: UUID, tokens, limit: int, cursor: Optional[int] = None):
+        """Returns the user's live notes carrying every one of tokens, in id order.
+
+        Matches are found through the (user_id, token) index, so the cost
+        depends on how many notes carry the tokens, not on the notebook size.
+        """
+        tokens = set(tokens)
+        stmt = (
+            select(models.Note)
+            .join(models.NoteToken, models.NoteToken.note_id == models.Note.id)
+            .where(models.NoteToken.user_id == user_id, models.NoteToken.token.in_(tokens),
+                   models.Note.deleted.is_(False))
+            .group_by(models.Note.id)
+            .having(func.count() == len(tokens))
+            .order_by(models.Note.id)
+            .limit(limit)
+        )
+        if cursor is not None:
+            stmt = stmt.where(models.Note.id > cursor)
+        result = await session.execute(stmt)
+        return result.scalars().all()
+
+    @staticmethod
+    async def get_live_note(session: AsyncSession, user_id: UUID, name: str):
+        """Returns the user's live note row, share-locked until the session's transaction ends.
+
+        The lock keeps the rotate job from re-encrypting the note's chunks
+        under another key while read_note_content streams them with this
+        row's key_id.
+        """
+        stmt = (
+            select(models.Note)
+            .where(models.Note.user_id == user_id, models.Note.name == name, models.Note.deleted.is_(False))
+            .with_for_update(read=True)
+        )
+        return (await session.execute(stmt)).scalar_one_or_none()
+
+    @staticmethod
+    async def write_note_content(session: AsyncSession, user, name: str, body, replace: bool = False):
+        """Stores note content streamed as pieces of one session-encrypted CFB ciphertext.
+
+        The content is re-encrypted at rest piece by piece and written to
+        note_chunk rows of NOTE_CHUNK_SIZE bytes as they fill, so memory use
+        does not depend on the size of the note.  Creates the note, or
+        replaces the content of an existing one if replace is set.  Returns
+        the number of chunks, or None if the note exists (create) or does not
+        exist (replace).
+        """
+        note_id = (await NoteService.existing_names(session, user.id, [name])).get(name)
+        if replace != (note_id is not None):
+            return None
+        if replace:
+            await NoteService.drop_chunks(session, [note_id])
+            await NoteService.set_tokens(session, user.id, {note_id: None})
+        else:
+            stmt = insert(models.Note).values(user_id=user.id, name=name, chunks=0).returning(models.Note.id)
+            note_id = (await session.execute(stmt)).scalar_one()
+
+        key_id, password = await data_keys.current(session, user.id)
+        decryptor = cipher.CFBDecryptor(await NoteService.session_password(user))
+        encryptor = await crypto_executor.run(cipher.CFBEncryptor, password)
+        chunks, length = 0, 0
+        async for data in split_stream(transcode_stream(body, decryptor, encryptor), NOTE_CHUNK_SIZE):
+            await session.execute(insert(models.NoteChunk).values(note_id=note_id, seq=chunks, data=data))
+            chunks, length = chunks + 1, length + len(data)
+
+        # The change_seq drawn by the insert above is replaced here, once the user row is locked, so that
+        # the lock is not held while the content streams in.
+        values = {'chunks': chunks, 'ciphertext_length': length, 'key_id': key_id,
+                  'change_seq': models.note_change_seq.next_value()}
+        if replace:
+            values.update(message=None, ciphertext=None, version=models.Note.version + 1)
+        await NoteService.lock_notebook(session, user.id)
+        stmt = (
+            update(models.Note)
+            .where(models.Note.id == note_id)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(stmt)
+        await NoteService.commit_notebook(session, user.id)
+        note_payloads.invalidate([note_id])
+        return chunks
+
+    @staticmethod
+    async def read_note_content(session: AsyncSession, user, note):
+        """Yields the content of a note row encrypted for the user's session, one at-rest chunk at a time.
+
+        Inline notes may be stored compressed (crypto.compression) and are
+        small, so they are decrypted and re-encrypted whole instead.
+        """
+        key = await data_keys.get(session, note.key_id)
+        if note.chunks is None:
+            yield await crypto_executor.run(transcode_inline, stored_ciphertext(note), key,
+                                            await NoteService.session_password(user))
+            return
+        stmt = (
+            select(models.NoteChunk.data)
+            .where(models.NoteChunk.note_id == note.id)
+            .order_by(models.NoteChunk.seq)
+            .execution_options(yield_per=1)
+        )
+        pieces = (await session.stream(stmt)).scalars()
+
+        decryptor = cipher.CFBDecryptor(key)
+        encryptor = await crypto_executor.run(cipher.CFBEncryptor, await NoteService.session_password(user))
+        async for data in transcode_stream(pieces, decryptor, encryptor):
+            yield data
@@ -1,7 +1,29 @@
 import os
 
 ADDRESS = os.getenv('BACKEND_URL', 'https://super-safe-evernote-backend.herokuapp.com/')
-KEY_EXPIRATION_TIME = os.getenv('KEY_EXPIRATION_TIME', 3600 * 4)
+KEY_EXPIRATION_TIME = int(os.getenv('KEY_EXPIRATION_TIME', 3600 * 4))
+SESSION_KEY_CACHE_SIZE = int(os.getenv('SESSION_KEY_CACHE_SIZE', 1024))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 4096))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 30))
+NOTE_PAYLOAD_CACHE_BYTES = int(os.getenv('NOTE_PAYLOAD_CACHE_BYTES', 64 * 1024 * 1024))
+CRYPTO_EXECUTOR = os.getenv('CRYPTO_EXECUTOR', 'thread')
+CRYPTO_WORKERS = int(os.getenv('CRYPTO_WORKERS', os.cpu_count() or 1))
+CRYPTO_CHUNK_SIZE = int(os.getenv('CRYPTO_CHUNK_SIZE', 16))
+NOTES_PAGE_SIZE = int(os.getenv('NOTES_PAGE_SIZE', 100))
+MAX_NOTES_PAGE_SIZE = int(os.getenv('MAX_NOTES_PAGE_SIZE', 1000))
+NOTES_STREAM_BATCH = int(os.getenv('NOTES_STREAM_BATCH', 64))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 500))
+MAX_INLINE_MESSAGE_LENGTH = int(os.getenv('MAX_INLINE_MESSAGE_LENGTH', 1024 * 1024))
+NOTE_CHUNK_SIZE = int(os.getenv('NOTE_CHUNK_SIZE', 64 * 1024))
+MAX_NOTE_TOKENS = int(os.getenv('MAX_NOTE_TOKENS', 1000))
+MAX_SEARCH_TOKENS = int(os.getenv('MAX_SEARCH_TOKENS', 16))
+CLI_CONCURRENCY = int(os.getenv('CLI_CONCURRENCY', 8))
+CLI_TIMEOUT = float(os.getenv('CLI_TIMEOUT', 300))
+CLI_STATE_DIR = os.getenv('CLI_STATE_DIR', os.path.join(os.path.expanduser('~'), '.evernote-cli'))
+MASTER_KEYS = os.getenv('MASTER_KEYS', '')
+KMS_KEY = os.getenv('KMS_KEY', '')
+SERVER_KEY_PROVIDER = os.getenv('SERVER_KEY_PROVIDER', 'kms' if KMS_KEY else 'file')
+SERVER_KEY_FILE = os.getenv('SERVER_KEY_FILE', 'server_key.json')
 JWT_SECRET = os.getenv('SECRET', 'sodijf0943wu0e9jf42emf34989fnmweiud94')
 MITM_PROXY = {
     'http': 'http://localhost:8080',
@@ -0,0 +1,71 @@
+"""Bytes on the wire and CPU time of note encryption with each compression codec.
+
+Run from the repository root: python -m tools.bench_compression
+"""
+import random
+import time
+
+from crypto import cipher, compression
+from crypto.encoding import decode_ciphertext, encode_ciphertext
+
+SIZES = [64, 512, 4096, 32768]
+WORDS = ('the note meeting tomorrow project deadline review budget draft team client call notes ideas list '
+         'buy milk bread eggs remember password server deploy fix bug release version plan week monday').split()
+
+
+def make_text(size, rng):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def check_round_trip(codecs):
+    rng = random.Random(1)
+    for codec in codecs.values():
+        for size in [0, 1, 127, 128, 5000]:
+            data = make_text(size, rng).encode()
+            packed = compression.compress(data, codec, threshold=compression.threshold)
+            assert compression.decompress(packed) == data
+    # Uncompressed UTF-8 never starts with a format byte.
+    assert compression.decompress('ünïcode'.encode()) == 'ünïcode'.encode()
+    print('round trips ok')
+
+
+def bench(name, codec, texts, password):
+    for text in texts:
+        data = text.encode()
+        start = time.perf_counter()
+        packed = compression.compress(data, codec, threshold=compression.threshold)
+        compressed_at = time.perf_counter()
+        ciphertext = encode_ciphertext(cipher.encrypt_CFB(packed, password))
+        encrypted_at = time.perf_counter()
+        assert compression.decompress(cipher.decrypt_CFB(decode_ciphertext(ciphertext), password)) == data
+        decrypted_at = time.perf_counter()
+        print(f'{name:>5} {len(data):>6} bytes: {len(ciphertext):>6} on the wire '
+              f'({len(ciphertext) / len(data):4.2f}x), compress {(compressed_at - start) * 1000:6.2f} ms, '
+              f'encrypt {(encrypted_at - compressed_at) * 1000:8.1f} ms, '
+              f'decrypt {(decrypted_at - encrypted_at) * 1000:7.1f} ms')
+
+
+def main():
+    codecs = {'none': None, 'zlib': compression.load_codec('zlib')}
+    try:
+        codecs['zstd'] = compression.load_codec('zstd')
+    except ImportError:
+        print('zstandard is not installed, skipping zstd')
+    check_round_trip(codecs)
+
+    rng = random.Random(0)
+    texts = [make_text(size, rng) for size in SIZES]
+    password = bytes(range(32))
+    print(f'threshold {compression.threshold} bytes')
+    for name, codec in codecs.items():
+        bench(name, codec, texts, password)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Differential checks and timing of crypto.ecc scalar multiplication and key generation.
+
+Run from the repository root: python -m tools.bench_ecc
+The curve is the one selected by ECC_CURVE.
+"""
+import random
+import time
+
+from crypto import ecc, ecdsa
+from crypto.ecdh import make_keypair
+
+
+def scaled(rounds):
+    """Cuts the number of differential rounds on 256-bit curves, where each one takes milliseconds."""
+    return rounds if ecc.curve.p < 10 ** 5 else max(1, rounds // 40)
+
+
+def check_against_affine(rounds=2000):
+    """Compares scalar_mult with the affine reference over random scalars and group points."""
+    points = sorted(ecc.generate_group(ecc.curve.a, ecc.curve.b, ecc.curve.p)) if ecc.curve.p < 10 ** 5 else []
+    points.append(ecc.curve.g)
+    rounds = scaled(rounds)
+    compared = 0
+    for _ in range(rounds):
+        point = random.choice(points)
+        k = random.randrange(-ecc.curve.n * 4, ecc.curve.n * 4)
+        try:
+            expected = ecc.scalar_mult_affine(k, point)
+        except ZeroDivisionError:
+            # The affine formulas cannot double points of order two.
+            continue
+        assert ecc.scalar_mult(k, point) == expected, (k, point)
+        compared += 1
+    print(f'{ecc.curve.name}: scalar_mult matches the affine reference on {compared} random scalars')
+
+
+def check_base_mult(rounds=2000):
+    """Compares the fixed-base table with the generic multiplication of curve.g."""
+    rounds = scaled(rounds)
+    for _ in range(rounds):
+        k = random.randrange(-ecc.curve.n * 4, ecc.curve.n * 4)
+        assert ecc.base_mult(k) == ecc.scalar_mult(k, ecc.curve.g), k
+    print(f'{ecc.curve.name}: base_mult matches scalar_mult on {rounds} random scalars')
+
+
+def check_ladder(rounds=2000):
+    """Compares the Montgomery ladder with scalar_mult."""
+    rounds = scaled(rounds)
+    points = [ecc.curve.g] + [make_keypair()[1] for _ in range(3)]
+    for _ in range(rounds):
+        k = random.randrange(-ecc.curve.n * 4, ecc.curve.n * 4)
+        point = random.choice(points)
+        assert ecc.ladder_mult(k, point) == ecc.scalar_mult(k, point), (k, point)
+    print(f'{ecc.curve.name}: ladder_mult matches scalar_mult on {rounds} random scalars')
+
+
+def check_multi_scalar_mult(rounds=500):
+    """Compares multi_scalar_mult with a sum of separate scalar_mult calls."""
+    rounds = scaled(rounds)
+    points = [ecc.curve.g] + [make_keypair()[1] for _ in range(3)]
+    for _ in range(rounds):
+        terms = [(random.randrange(-ecc.curve.n, ecc.curve.n), random.choice(points)) for _ in range(3)]
+        expected = None
+        for k, point in terms:
+            expected = ecc._from_jacobian(ecc._jacobian_add(ecc._to_jacobian(expected),
+                                                            ecc._to_jacobian(ecc.scalar_mult(k, point))))
+        assert ecc.multi_scalar_mult(terms) == expected, terms
+    print(f'{ecc.curve.name}: multi_scalar_mult matches separate multiplications on {rounds} sums')
+
+
+def bench_verify(count=200, signers=4):
+    keys = [make_keypair() for _ in range(signers)]
+    items = []
+    for i in range(count):
+        private_key, public_key = keys[i % signers]
+        message = f'note {i}'.encode()
+        items.append((public_key, message, ecdsa.sign_message(private_key, message)))
+    expected = [i for i, item in enumerate(items) if ecdsa.verify_signature(*item) != 'signature matches']
+
+    start = time.perf_counter()
+    failed = ecdsa.verify_batch(items)
+    batch = time.perf_counter() - start
+    assert failed == expected, (failed, expected)
+
+    start = time.perf_counter()
+    for item in items:
+        ecdsa.verify_signature(*item)
+    single = time.perf_counter() - start
+    print(f'verify_batch: {count / batch:9.1f} signatures per second ({signers} signers)')
+    print(f'verify_signature: {count / single:9.1f} signatures per second')
+
+
+def check_group(primes=(71, 97, 257, 1009)):
+    """Compares generate_group with a brute-force search over every (x, y)."""
+    for p in primes:
+        squares = {}
+        for y in range(1, p):
+            squares.setdefault(y * y % p, []).append(y)
+        expected = {(x, y) for x in range(1, p) for y in squares.get((x ** 3 + 7) % p, ())}
+        assert ecc.generate_group(0, 7, p) == expected, p
+    print(f'generate_group matches brute force for p in {primes}')
+
+
+def bench_group(primes=(10007, 100003, 1000003)):
+    for p in primes:
+        start = time.perf_counter()
+        size = sum(1 for _ in ecc.iter_group(0, 7, p))
+        print(f'iter_group(0, 7, {p}): {size} points in {time.perf_counter() - start:.2f} s')
+
+
+def bench(name, func, repeat=200):
+    scalars = [random.randrange(1, ecc.curve.n) for _ in range(repeat)]
+    start = time.perf_counter()
+    for k in scalars:
+        func(k, ecc.curve.g)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'{name:>8}: {elapsed * 1e6:9.1f} us per multiplication')
+
+
+def bench_keypairs(seconds=1.0):
+    start = time.perf_counter()
+    ecc.base_mult(1)
+    print(f'fixed-base table built in {(time.perf_counter() - start) * 1e3:.1f} ms')
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        make_keypair()
+        count += 1
+    print(f'make_keypair: {count / (time.perf_counter() - start):9.1f} keypairs per second')
+
+
+def main():
+    check_against_affine()
+    check_base_mult()
+    check_ladder()
+    check_multi_scalar_mult()
+    check_group()
+    bench('jacobian', ecc.scalar_mult)
+    bench('affine', ecc.scalar_mult_affine)
+    bench('base', lambda k, point: ecc.base_mult(k))
+    bench('ladder', ecc.ladder_mult)
+    bench_keypairs()
+    bench_verify()
+    bench_group()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Handshakes per second on one core for every curve in crypto.ecc.CURVES.
+
+A server-side handshake is one make_keypair() plus one ladder_mult() of the
+client's public key.  Each curve runs in its own interpreter because the
+curve is fixed when crypto.ecc is imported.
+
+Run from the repository root: python -m tools.bench_handshake [--curve NAME]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+def bench(seconds):
+    from crypto import ecc
+    from crypto.ecdh import make_keypair
+
+    start = time.perf_counter()
+    ecc.base_mult(1)
+    table = time.perf_counter() - start
+    client_private_key, client_public_key = make_keypair()
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        server_private_key, server_public_key = make_keypair()
+        server_secret = ecc.ladder_mult(server_private_key, client_public_key)
+        count += 1
+    elapsed = time.perf_counter() - start
+
+    assert server_secret == ecc.ladder_mult(client_private_key, server_public_key)
+    print(f'{ecc.curve.name:>10}: {count / elapsed:9.1f} handshakes per second per core '
+          f'(fixed-base table {table * 1e3:.1f} ms)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--curve', help='benchmark only this curve, in this process')
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.curve:
+        os.environ['ECC_CURVE'] = args.curve
+        bench(args.seconds)
+        return
+
+    from crypto.ecc import CURVES
+    for name in CURVES:
+        subprocess.run([sys.executable, '-m', 'tools.bench_handshake', '--curve', name,
+                        '--seconds', str(args.seconds)], check=True)
+
+
+if __name__ == '__main__':
+    main()
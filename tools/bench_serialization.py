@@ -0,0 +1,85 @@
+"""Time to turn a page of encrypted notes into a /get_notes response body, before and after ORJSONResponse.
+
+Before: encrypt_rows built detached models.Note copies, which FastAPI
+walked with jsonable_encoder and rendered with the json module.  After:
+encrypt_rows builds ListedNote dicts, which notes_page hands to orjson.
+Both start from the same session-encrypted payloads, served by the note
+payload cache, so no crypto or database work is timed.
+
+Run from the repository root: python -m tools.bench_serialization
+"""
+import asyncio
+import json
+import time
+import uuid
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from crypto.ecdh import make_keypair
+from crypto.encoding import encode_point
+from main import notes_page
+from src import models
+from src.cache import key_fingerprint, note_payloads
+from src.service import ChannelUser, NoteService
+
+NOTES = 5000
+ROUNDS = 5
+
+
+def make_rows(user_id):
+    return [models.Note(id=i, user_id=user_id, version=1, change_seq=i, deleted=False, chunks=None, name=f'note {i}')
+            for i in range(NOTES)]
+
+
+def make_payloads(rows, peer):
+    fingerprint = key_fingerprint(peer.password)
+    for row in rows:
+        payload = ('v1:' + 'n' * 43, 'v1:' + 'm' * 200)
+        note_payloads.store((row.id, row.version, fingerprint, False), payload)
+    return [note_payloads.get((row.id, row.version, fingerprint, False)) for row in rows]
+
+
+def before(rows, payloads):
+    notes = [
+        models.Note(id=row.id, user_id=row.user_id, version=row.version, change_seq=row.change_seq,
+                    deleted=row.deleted, chunks=row.chunks, name=name, message=message)
+        for row, (name, message) in zip(rows, payloads)
+    ]
+    content = asyncio.run(serialize_response(response_content={"message": notes, "next_cursor": None}))
+    return JSONResponse(content).body
+
+
+def after(rows, peer):
+    notes = asyncio.run(NoteService.encrypt_rows(None, peer, rows))
+    return notes_page(notes, next_cursor=None).body
+
+
+def best_of(func, *args):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        body = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, body
+
+
+def main():
+    user_id = uuid.uuid4()
+    peer = ChannelUser(user_id, encode_point(make_keypair()[1], False), bytes(32))
+    rows = make_rows(user_id)
+    payloads = make_payloads(rows, peer)
+
+    before_time, before_body = best_of(before, rows, payloads)
+    after_time, after_body = best_of(after, rows, peer)
+    old, new = json.loads(before_body)['message'], json.loads(after_body)['message']
+    assert [(n['id'], n['name'], n['message']) for n in old] == [(n['id'], n['name'], n['message']) for n in new]
+
+    print(f'{NOTES} notes, best of {ROUNDS}')
+    print(f'before: {before_time * 1000:7.1f} ms, {len(before_body)} bytes')
+    print(f'after:  {after_time * 1000:7.1f} ms, {len(after_body)} bytes ({before_time / after_time:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
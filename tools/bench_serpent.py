@@ -0,0 +1,97 @@
+"""Known-answer checks and throughput of the Serpent backends.
+
+Run from the repository root: python -m tools.bench_serpent
+"""
+import os
+import time
+from unittest import mock
+
+from crypto import serpent
+
+# (key, plaintext, ciphertext) produced by zpp_serpent.serpent.encrypt.
+KNOWN_ANSWERS = [
+    ('00' * 32, '00' * 16, '92e6d415199bb19f0a981820a2920891'),
+    ('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f',
+     '000102030405060708090a0b0c0d0e0f', '7efd703f43d1549f14d0dac354a8c4a0'),
+    ('ff' * 32, '80' + '00' * 15, '6e556f738064fd0d101dd73ea9abeb34'),
+]
+
+SIZES = [16, 100, 1000, 10000]
+
+
+def check_known_answers():
+    for key, plaintext, ciphertext in KNOWN_ANSWERS:
+        key, plaintext, ciphertext = bytes.fromhex(key), bytes.fromhex(plaintext), bytes.fromhex(ciphertext)
+        assert serpent.encrypt_blocks(plaintext, key) == ciphertext
+        assert serpent.decrypt_blocks(ciphertext, key) == plaintext
+    print(f'{len(KNOWN_ANSWERS)} block vectors ok')
+
+
+def check_against_zpp(zpp_serpent):
+    password = os.urandom(32)
+    for size in [1, 15, 16, 17, 100]:
+        plaintext = os.urandom(size)
+        salt = os.urandom(serpent.SALT_SIZE)
+        with mock.patch('os.urandom', return_value=salt):
+            expected = zpp_serpent.encrypt_CFB(plaintext, password)
+            actual = serpent.encrypt_CFB(plaintext, password)
+        assert expected == actual, f'CFB output differs for {size} bytes'
+        assert serpent.decrypt_CFB(expected, password) == zpp_serpent.decrypt_CFB(actual, password)
+    # Whole blocks are encrypted without padding, yet both strip a tail that looks like padding.
+    plaintext = os.urandom(31) + b'\x01'
+    for module in serpent, zpp_serpent:
+        assert module.decrypt_CFB(module.encrypt_CFB(plaintext, password), password) == plaintext[:-1]
+    print('CFB output identical to zpp_serpent')
+
+
+def check_streams():
+    password = os.urandom(32)
+    for size in [1, 15, 16, 17, 100, 1000]:
+        plaintext = os.urandom(size)
+        salt = os.urandom(serpent.SALT_SIZE)
+        for piece in [1, 7, 16, 33]:
+            # Streams always end with a padded block; encrypt_CFB adds none to whole blocks.
+            padded = plaintext if size % serpent.BLOCK_SIZE else plaintext + serpent._pad(b'')
+            with mock.patch('os.urandom', return_value=salt):
+                expected = serpent.encrypt_CFB(padded, password)
+                encryptor = serpent.CFBEncryptor(password)
+            actual = b''.join(encryptor.update(plaintext[i:i + piece]) for i in range(0, size, piece))
+            actual += encryptor.finalize()
+            assert expected == actual, f'CFBEncryptor output differs for {size} bytes in pieces of {piece}'
+
+            decryptor = serpent.CFBDecryptor(password)
+            decrypted = b''.join(decryptor.update(actual[i:i + piece]) for i in range(0, len(actual), piece))
+            assert decrypted + decryptor.finalize() == plaintext
+    print('CFB streams match encrypt_CFB and round-trip')
+
+
+def bench(name, module, repeat):
+    password = os.urandom(32)
+    for size in SIZES:
+        plaintext = os.urandom(size)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            module.decrypt_CFB(module.encrypt_CFB(plaintext, password), password)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f'{name:>5} {size:>6} bytes: {elapsed * 1000:9.1f} ms per round trip, '
+              f'{2 * size / elapsed / 1024:9.1f} KiB/s')
+
+
+def main():
+    check_known_answers()
+    check_streams()
+    try:
+        import zpp_serpent
+    except ImportError:
+        zpp_serpent = None
+        print('zpp_serpent is not installed, skipping comparison')
+    else:
+        check_against_zpp(zpp_serpent)
+
+    bench('fast', serpent, repeat=5)
+    if zpp_serpent is not None:
+        bench('zpp', zpp_serpent, repeat=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""End-to-end check that handshakes and notes work across several uvicorn workers without sticky sessions.
+
+Starts the app with --workers and drives it from one client whose every
+request opens a new connection, so requests land on arbitrary workers.  The
+client re-handshakes periodically and checks every note it reads back.
+Needs the database from POSTGRES_URL and MASTER_KEYS.
+
+Run from the repository root: python -m tools.check_workers --workers 4
+Run with --provider env to see the per-process keys this replaces fail.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import requests
+
+from cli.utils import decrypt_note, encrypt_note
+from crypto.ecc import ladder_mult
+from crypto.ecdh import make_keypair
+from crypto.encoding import decode_point, encode_point
+
+
+def start_server(args):
+    env = dict(os.environ, SERVER_KEY_PROVIDER=args.provider)
+    env.pop('private_key', None)
+    env.pop('public_key', None)
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(args.port),
+                               '--workers', str(args.workers), '--log-level', 'warning'], env=env)
+    address = f'http://127.0.0.1:{args.port}/'
+    for _ in range(300):
+        try:
+            requests.get(address + 'metrics', timeout=1)
+            return server, address
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('the server did not start')
+
+
+class Client:
+    def __init__(self, address):
+        self.address = address
+        self.headers = None
+        self.secret = None
+
+    def login(self):
+        email, password = f'{uuid.uuid4().hex}@example.com', uuid.uuid4().hex
+        requests.post(self.address + 'auth/register', json={'email': email, 'password': password})
+        response = requests.post(self.address + 'auth/jwt/login', data={'username': email, 'password': password})
+        self.headers = {'Authorization': f'Bearer {response.json()["access_token"]}'}
+
+    def handshake(self):
+        private_key, public_key = make_keypair()
+        response = requests.get(self.address + 'get_public_key', json={'public_key': encode_point(public_key)},
+                                headers=self.headers)
+        self.secret = ladder_mult(private_key, decode_point(response.json()['public_key']))[0]
+
+    def create(self, name, content):
+        name, content = encrypt_note(self.secret, name, content)
+        response = requests.post(self.address + 'create_note', json={'name': name, 'message': content},
+                                 headers=self.headers)
+        return response.json()['message'] != 'ECDH error'
+
+    def notes(self):
+        response = requests.get(self.address + 'get_notes', params={'limit': 1000}, headers=self.headers)
+        message = response.json()['message']
+        if not isinstance(message, list):
+            return None
+        try:
+            return dict(decrypt_note(self.secret, note['name'], note['message']) for note in message)
+        except Exception:
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that several workers share one server key.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--provider', default='file')
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--handshake-every', type=int, default=5)
+    args = parser.parse_args()
+
+    server, address = start_server(args)
+    try:
+        client = Client(address)
+        client.login()
+        expected, failures, workers = {}, 0, set()
+        for i in range(args.rounds):
+            if i % args.handshake_every == 0:
+                client.handshake()
+            expected[f'note{i}'] = f'body {i}'
+            if not client.create(f'note{i}', f'body {i}'):
+                failures += 1
+                del expected[f'note{i}']
+            if client.notes() != expected:
+                failures += 1
+            workers.add(requests.get(address + 'metrics').json()['worker'])
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f'{args.rounds} rounds on {len(workers)} of {args.workers} workers ({args.provider} keys): '
+          f'{failures} failures')
+    sys.exit(1 if failures or len(workers) < min(2, args.workers) else 0)
+
+
+if __name__ == '__main__':
+    main()